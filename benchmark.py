@@ -0,0 +1,352 @@
+import argparse
+import contextlib
+import csv
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from seach_engine import TOKEN_MODES, SearchEngine
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'zu', 'be', 'da', 'fo', 'gi', 'ha', 'po', 'te']
+
+
+def _zipf_weights(n, a):
+    weights = 1.0 / np.arange(1, n + 1) ** a
+    return weights / weights.sum()
+
+
+def _duplicated_rows(clicked):
+    return (clicked[:, 0] == clicked[:, 1]) | (clicked[:, 0] == clicked[:, 2]) | (clicked[:, 1] == clicked[:, 2])
+
+
+def _make_vocabulary(rng, n_words):
+    words = set()
+    while len(words) < n_words:
+        words.add(''.join(rng.choice(SYLLABLES, rng.integers(2, 4))))
+    return sorted(words)
+
+
+def _make_terms(rng, n_terms, n_words, zipf_a):
+    """
+    search terms of 1-4 words, words drawn by Zipf so a few words appear in many terms like real queries.
+    the returned list is ordered by popularity.
+    """
+    words = _make_vocabulary(rng, n_words)
+    word_p = _zipf_weights(n_words, zipf_a)
+    terms = dict()
+    while len(terms) < n_terms:
+        ids = rng.choice(n_words, rng.integers(1, 5), p=word_p)
+        terms.setdefault(' '.join(words[i] for i in ids), None)
+    return list(terms)
+
+
+def generate_reports(dirpath, weeks=8, rows=20000, seed=0, zipf_a=1.1, site='Amazon.com', start=date(2021, 1, 3)):
+    """
+    write synthetic weekly Brand Analytics search term reports: the Viewing=[...] header row, the column row,
+    and `rows` terms ranked 1..rows with 3 clicked ASINs x 4 fields each.
+    terms and ASINs are Zipf distributed, popular terms stay near the top from week to week with some churn.
+    :return: generated csv paths
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(dirpath, exist_ok=True)
+    terms = _make_terms(rng, rows * 3, max(rows // 10, 50), zipf_a)
+    log_term_p = np.log(_zipf_weights(len(terms), zipf_a))
+    asins = np.array([f'B0{i:08X}' for i in rng.choice(16 ** 8, rows, replace=False)])
+    asin_p = _zipf_weights(len(asins), zipf_a)
+    header = ['Department', 'Search Term', 'Search Frequency Rank']
+    for i in range(1, 4):
+        header += [f'#{i} Clicked ASIN', f'#{i} Product Title', f'#{i} Click Share', f'#{i} Conversion Share']
+    paths = []
+    for week in range(weeks):
+        first_day = start + timedelta(weeks=week)
+        last_day = first_day + timedelta(days=6)
+        viewing = f'{first_day.month}/{first_day.day}/{first_day:%y} - {last_day.month}/{last_day.day}/{last_day:%y}'
+        # Gumbel top-k: a weighted sample without replacement, already in rank order
+        keys = log_term_p + rng.gumbel(size=len(terms))
+        ranked = np.argsort(-keys)[:rows]
+        clicked = rng.choice(len(asins), (rows, 3), p=asin_p)
+        # the 3 clicked ASINs of a term are distinct in real reports
+        duplicated = _duplicated_rows(clicked)
+        while duplicated.any():
+            clicked[duplicated] = rng.choice(len(asins), (duplicated.sum(), 3), p=asin_p)
+            duplicated = _duplicated_rows(clicked)
+        clicked = asins[clicked]
+        click_share = np.sort(rng.dirichlet([4, 2, 1], rows) * rng.uniform(0.1, 1, (rows, 1)), axis=1)[:, ::-1]
+        conversion_share = click_share * rng.uniform(0, 0.6, (rows, 3))
+        path = os.path.join(dirpath, f'US_Search_Terms_Weekly_{first_day}.csv')
+        with open(path, 'w', newline='', encoding='UTF-8') as fp:
+            writer = csv.writer(fp)
+            writer.writerow([f'Department=[{site}]', 'Report Range=[Weekly]', f'Select week=[Week {week + 1}]',
+                             'Reporting Range=[Weekly]', f'Viewing=[{viewing}]'])
+            writer.writerow(header)
+            for rank, term_id in enumerate(ranked):
+                row = [site, terms[term_id], f'{rank + 1:,}']
+                for i in range(3):
+                    asin = clicked[rank, i]
+                    row += [asin, f'Product {asin}', f'{click_share[rank, i]:.2%}', f'{conversion_share[rank, i]:.2%}']
+                writer.writerow(row)
+        paths.append(path)
+    return paths
+
+
+def default_params(dirpath):
+    """
+    pick parameters that hit data for every by: the most common word and term, a rank threshold,
+    the most clicked ASINs of the first report, a conversion share threshold and those ASINs split over 3 brands.
+    the token modes get the top term with its words reversed, with its longest word misspelled for fuzzy.
+    """
+    report = pd.read_csv(sorted(SearchEngine()._get_abs_files_data(dirpath)['csv'])[0], skiprows=1, dtype=str)
+    words = report.iloc[:, 1].str.split().explode().value_counts()
+    asins = report.iloc[:, [3, 7, 11]].stack().value_counts()
+    rank_threshold = max(len(report) // 100, 1)
+    term_words = report.iloc[0, 1].split()
+    longest = max(term_words, key=len)
+    typo = longest[0] + longest[2] + longest[1] + longest[3:] if len(longest) > 3 else longest
+    return {
+        'search term': {'loose': [words.index[0]], 'exact': [report.iloc[0, 1]], 'all': [' '.join(term_words[::-1])],
+                        'any': [' '.join(term_words[::-1])],
+                        'fuzzy': [' '.join(typo if w == longest else w for w in term_words[::-1])]},
+        'search frequency rank': rank_threshold,
+        'asin detail': list(asins.index[:2]),
+        'conversion share term': 20,
+        'brand share': {asin: f'brand {i % 3}' for i, asin in enumerate(asins.index[:30])},
+    }
+
+
+def _param_for(params, by, mode):
+    if by in ['asin detail', 'conversion share term', 'brand share']:
+        return params[by]
+    if 'rank' in by:
+        return params['search frequency rank']
+    return params['search term'][mode]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(dirpath, engines=None, bys=None, modes=None, repeat=3, workers=1):
+    """
+    time loading and every by x mode on each engine against the reports in dirpath.
+    parse and result caches are disabled so each number is the real cost.
+    :return: one record per (engine, stage, by, mode)
+    """
+    engines = engines or SearchEngine.AVAILABLE_ENGINE
+    bys = bys or SearchEngine.AVAILABLE_BY
+    modes = modes or SearchEngine.AVAILABLE_MODE
+    params = default_params(dirpath)
+    records = []
+    for engine in engines:
+        st_object = SearchEngine(engine, use_cache=False, workers=workers, result_cache=False)
+        abs_file_data = st_object._get_abs_files_data(dirpath)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            st_object.set_search_term_data('asin detail', engine, abs_file_data)
+        records.append({'engine': engine, 'stage': 'load', 'by': None, 'mode': None,
+                        'seconds': [round(time.perf_counter() - start, 4)], 'rows': len(st_object.st_data),
+                        'error': None})
+        print(_format_record(records[-1]))
+        for by in bys:
+            for mode in modes + (TOKEN_MODES if by in SearchEngine.TERM_BY else []):
+                record = {'engine': engine, 'stage': 'search', 'by': by, 'mode': mode, 'seconds': [], 'rows': None,
+                          'error': None}
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    try:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            bind_df = st_object.run_query(by, _param_for(params, by, mode), mode, engine)
+                    except (Exception, SystemExit) as e:
+                        record['error'] = repr(e)
+                        break
+                    record['seconds'].append(round(time.perf_counter() - start, 4))
+                    record['rows'] = len(bind_df)
+                records.append(record)
+                print(_format_record(record))
+    return records
+
+
+def check_excel_export(dirpath, engine='pandas', sheet_rows=1000):
+    """
+    save one query result as xlsx and read it back, with the sheet row limit lowered to sheet_rows so the
+    sheet and file splitting is exercised too. reading back needs openpyxl.
+    :return: None when the re-read sheets equal the result, otherwise a description of the mismatch
+    """
+    params = default_params(dirpath)
+    st_object = SearchEngine(engine, use_cache=False, result_cache=False, output_format='xlsx')
+    st_object.EXCEL_MAX_ROWS = sheet_rows
+    with contextlib.redirect_stdout(io.StringIO()):
+        st_object.set_search_term_data('asin detail', engine, st_object._get_abs_files_data(dirpath))
+        bind_df = st_object.run_query('search term', _param_for(params, 'search term', 'loose'), 'loose', engine)
+    with tempfile.TemporaryDirectory() as save_dirpath:
+        with contextlib.redirect_stdout(io.StringIO()):
+            save_file_paths = st_object.save_search(bind_df, 'search term', 'check', 'loose', engine, dirpath,
+                                                    save_dirpath)
+        sheets = [sheet_df for save_file_path in save_file_paths
+                  for sheet_df in pd.read_excel(save_file_path, sheet_name=None, index_col=0).values()]
+    read_df = pd.concat(sheets) if sheets else pd.DataFrame()
+    if read_df.shape != bind_df.shape:
+        return f'xlsx shape {read_df.shape} != result shape {bind_df.shape}'
+    written = bind_df.astype(object).where(bind_df.notna(), None).to_numpy()
+    read = read_df.astype(object).where(read_df.notna(), None).to_numpy()
+    mismatched = int((written != read).sum())
+    if mismatched:
+        return f'{mismatched} xlsx cells differ from the result'
+    return None
+
+
+def check_refresh(dirpath, engine='pandas'):
+    """
+    load all but the last two reports, then refresh twice: first with the next report and an empty csv
+    (a download in progress) that fails to parse, then with the empty csv gone and the last report added.
+    the result must equal a full load of the same reports: rows, queries and the window rank stats.
+    :return: None when the refreshed data equals the full load, otherwise a description of the mismatch
+    """
+    params = default_params(dirpath)
+    files = sorted(SearchEngine()._get_abs_files_data(dirpath)['csv'])
+    if len(files) < 3:
+        return None
+    with tempfile.TemporaryDirectory() as tmp_dirpath, contextlib.redirect_stdout(io.StringIO()):
+        for file in files[:-2]:
+            shutil.copy(file, tmp_dirpath)
+        refreshed = _sorted_listing(SearchEngine(engine, use_cache=False, result_cache=False))
+        refreshed.set_search_term_data('asin detail', engine, refreshed._get_abs_files_data(tmp_dirpath))
+        refreshed.get_term_index(refreshed.st_data)
+        refreshed.get_rank_stats(refreshed.st_data)
+        shutil.copy(files[-2], tmp_dirpath)
+        empty_file = os.path.join(tmp_dirpath, 'zz_downloading.csv')
+        open(empty_file, 'w').close()
+        try:
+            refreshed.refresh()
+        except Exception:
+            pass
+        else:
+            return 'refresh with an empty csv did not fail'
+        os.remove(empty_file)
+        shutil.copy(files[-1], tmp_dirpath)
+        refreshed.refresh()
+        full = _sorted_listing(SearchEngine(engine, use_cache=False, result_cache=False))
+        full.set_search_term_data('asin detail', engine, full._get_abs_files_data(tmp_dirpath))
+        loads = []
+        for name, st_object in [('refreshed', refreshed), ('full', full)]:
+            stats = st_object.get_window(st_object.st_data, '2000-01-01', '2099-12-30')['rank_stats']
+            results = [st_object.run_query(by, _param_for(params, by, 'loose'), 'loose', engine)
+                       for by in ['search term', 'asin detail', 'search frequency rank']]
+            loads.append((len(st_object.st_data), int(stats['weeks'].sum()), results))
+    (refreshed_rows, refreshed_weeks, refreshed_results), (full_rows, full_weeks, full_results) = loads
+    if (refreshed_rows, refreshed_weeks) != (full_rows, full_weeks):
+        return f'refreshed rows/weeks {refreshed_rows}/{refreshed_weeks} != full load {full_rows}/{full_weeks}'
+    for by, refreshed_df, full_df in zip(['search term', 'asin detail', 'search frequency rank'],
+                                         refreshed_results, full_results):
+        if not _canonical(refreshed_df).equals(_canonical(full_df)):
+            return f'{by}: refreshed result differs from the full load'
+    return None
+
+
+def _sorted_listing(st_object):
+    """
+    files are loaded in directory listing order; sorted, the next report parses before the empty csv.
+    """
+    list_files = st_object._get_abs_files_data
+    st_object._get_abs_files_data = lambda dirpath: {**list_files(dirpath), 'csv': sorted(list_files(dirpath)['csv'])}
+    return st_object
+
+
+def _canonical(bind_df):
+    bind_df = bind_df.astype(str).sort_index(axis=1)
+    return bind_df.sort_values(list(bind_df.columns)).reset_index(drop=True)
+
+
+def _format_record(record):
+    name = f"{record['engine']:<7} {record['stage']:<7} {record['by'] or '':<28} {record['mode'] or '':<6}"
+    if record['error']:
+        return f'{name} error: {record["error"]}'
+    return f"{name} {min(record['seconds']):>9.4f}s  rows={record['rows']}"
+
+
+def append_history(history_path, records, scale):
+    """
+    append one run to the JSON Lines history, each line carries the run context so runs can be compared later.
+    """
+    run = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'scale': scale,
+    }
+    with open(history_path, 'a', encoding='UTF-8') as fp:
+        for record in records:
+            fp.write(json.dumps({**run, **record}, ensure_ascii=False) + '\n')
+
+
+def compare_history(history_path, scale, threshold=1.2, min_seconds=0.05):
+    """
+    compare the latest run with the previous run at the same scale, using the best time of each measurement.
+    measurements that now take under min_seconds are too noisy to compare and are skipped.
+    :return: (key, previous seconds, latest seconds) for measurements slower than threshold x previous
+    """
+    runs = dict()
+    with open(history_path, encoding='UTF-8') as fp:
+        for line in fp:
+            record = json.loads(line)
+            if record['scale'] == scale and record['seconds']:
+                key = (record['engine'], record['stage'], record['by'], record['mode'])
+                runs.setdefault(record['time'], dict())[key] = min(record['seconds'])
+    if len(runs) < 2:
+        return []
+    previous, latest = [runs[t] for t in sorted(runs)[-2:]]
+    return [(key, previous[key], seconds) for key, seconds in latest.items()
+            if key in previous and seconds > previous[key] * threshold and seconds >= min_seconds]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='品牌分析搜索基准测试 (合成数据)')
+    parser.add_argument('--weeks', type=int, default=8, help='生成的周报数量')
+    parser.add_argument('--rows', type=int, default=20000, help='每周搜索词数量')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=None, help='数据文件夹，已有 csv 时直接使用，默认按规模生成到临时目录')
+    parser.add_argument('--engines', nargs='+', choices=SearchEngine.AVAILABLE_ENGINE, default=None)
+    parser.add_argument('--repeat', type=int, default=3, help='每个查询重复次数，取最快一次')
+    parser.add_argument('--workers', type=int, default=1, help='并行读取进程数')
+    parser.add_argument('--history', default='bench_history.jsonl', help='结果历史 (JSON Lines)')
+    parser.add_argument('--threshold', type=float, default=1.2, help='比上次慢多少倍视为退化')
+    args = parser.parse_args(argv)
+
+    scale = {'weeks': args.weeks, 'rows': args.rows, 'seed': args.seed}
+    dirpath = args.data_dir or os.path.join(tempfile.gettempdir(), f'ba_bench_{args.weeks}x{args.rows}_{args.seed}')
+    if not (os.path.isdir(dirpath) and SearchEngine()._get_abs_files_data(dirpath)['csv']):
+        print(f'generating {args.weeks} x {args.rows} rows in {dirpath}')
+        generate_reports(dirpath, args.weeks, args.rows, args.seed)
+    records = run_benchmark(dirpath, args.engines, repeat=args.repeat, workers=args.workers)
+    append_history(args.history, records, scale)
+    regressions = compare_history(args.history, scale, args.threshold)
+    for key, previous, latest in regressions:
+        print(f'slower: {key} {previous:.4f}s -> {latest:.4f}s')
+    excel_error = check_excel_export(dirpath) if importlib.util.find_spec('openpyxl') else None
+    if excel_error:
+        print(f'xlsx export: {excel_error}')
+    refresh_errors = [f'{engine}: {error}' for engine in args.engines or SearchEngine.AVAILABLE_ENGINE
+                      for error in [check_refresh(dirpath, engine)] if error]
+    for error in refresh_errors:
+        print(f'refresh: {error}')
+    return 1 if regressions or excel_error or refresh_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,1511 @@
+import bisect
+import cProfile
+import contextlib
 import csv
+import functools
+import hashlib
+import heapq
+import importlib.util
+import io
+import itertools
+import json
 import os
+import re
+import shutil
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
 from utils.basic import verified_input
 
 
-def _calc_rank(b, s, v):
-    if 'asin' in b:
-        if not v['avg_rank']: v['avg_rank'] = sum(s) / len(s)
-        if not v['min_rank']: v['min_rank'] = min(s)
-        if not v['max_rank']: v['max_rank'] = max(s)
+CACHE_DIRNAME = '.ba_cache'
+CACHE_VERSION = 1
 
 
-class SearchEngine:
-    ST_DICT = {}
+def _has_module(name):
+    return importlib.util.find_spec(name) is not None
+
+
+def _file_fingerprint(file):
+    stat = os.stat(file)
+    return {'path': os.path.abspath(file), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def _dataset_version(files):
+    """
+    version of a set of source files: changes whenever a file is added, removed or modified.
+    :param files:
+    :return: hex digest
+    """
+    fingerprints = sorted((fp['path'], fp['size'], fp['mtime']) for fp in map(_file_fingerprint, files))
+    return hashlib.md5(json.dumps(fingerprints).encode('UTF-8')).hexdigest()
+
+
+def _parse_viewing_date(header_row):
+    return header_row[4].replace('Viewing=[', '').replace(']', '')
+
+
+class ReportCache:
+    """
+    品牌分析 csv 的解析缓存，每个源文件一个条目，以 (路径, 大小, 修改时间) 作为指纹。
+    有 pyarrow 时存为 parquet，否则存为 pickle。
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, cache_dirpath, fmt=None):
+        self.cache_dirpath = cache_dirpath
+        os.makedirs(cache_dirpath, exist_ok=True)
+        if fmt is None:
+            fmt = 'parquet' if _has_module('pyarrow') else 'pickle'
+        self.fmt = fmt
+        self.manifest = self._read_manifest()
+
+    def _manifest_path(self):
+        return os.path.join(self.cache_dirpath, self.MANIFEST)
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path(), 'r', encoding='UTF-8') as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != CACHE_VERSION:
+            return {}
+        return manifest.get('entries', {})
+
+    def _write_manifest(self):
+        tmp_path = self._manifest_path() + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as fp:
+            json.dump({'version': CACHE_VERSION, 'entries': self.manifest}, fp, ensure_ascii=False)
+        os.replace(tmp_path, self._manifest_path())
+
+    def _entry_path(self, path, fmt):
+        name = hashlib.md5(path.encode('UTF-8')).hexdigest()
+        return os.path.join(self.cache_dirpath, f'{name}.{fmt}')
+
+    def has(self, file):
+        fingerprint = _file_fingerprint(file)
+        entry = self.manifest.get(fingerprint['path'])
+        return entry is not None and entry['size'] == fingerprint['size'] and entry['mtime'] == fingerprint['mtime']
+
+    def get(self, file):
+        """
+        :param file: source csv path
+        :return: (date, report_df) if the cached entry still matches the file, else None
+        """
+        if not self.has(file):
+            return None
+        fingerprint = _file_fingerprint(file)
+        entry = self.manifest[fingerprint['path']]
+        entry_path = self._entry_path(fingerprint['path'], entry['fmt'])
+        try:
+            if entry['fmt'] == 'parquet':
+                report_df = pd.read_parquet(entry_path)
+            else:
+                report_df = pd.read_pickle(entry_path)
+        except (OSError, ValueError):
+            return None
+        return entry['date'], report_df
+
+    def put(self, file, date, report_df):
+        fingerprint = _file_fingerprint(file)
+        entry_path = self._entry_path(fingerprint['path'], self.fmt)
+        if self.fmt == 'parquet':
+            report_df.to_parquet(entry_path, index=False)
+        else:
+            report_df.to_pickle(entry_path)
+        self.manifest[fingerprint['path']] = {**fingerprint, 'date': date, 'fmt': self.fmt}
+        self._write_manifest()
+
+    def _index_path(self, name, version):
+        return os.path.join(self.cache_dirpath, f'{name}-{version}.pickle')
+
+    def load_index(self, name, version):
+        try:
+            return pd.read_pickle(self._index_path(name, version))
+        except (OSError, ValueError, EOFError):
+            return None
+
+    def save_index(self, name, version, index):
+        """
+        persist an index built over the dataset `version`; older versions of the same index are removed.
+        """
+        for item in os.listdir(self.cache_dirpath):
+            if item.startswith(f'{name}-') and item.endswith('.pickle'):
+                os.remove(os.path.join(self.cache_dirpath, item))
+        pd.to_pickle(index, self._index_path(name, version))
+
+    def _columns_path(self, version):
+        return os.path.join(self.cache_dirpath, f'columns-{version}')
+
+    def load_columns(self, version):
+        """
+        :return: MappedStore of the dataset `version`, None if it was not saved
+        """
+        try:
+            return MappedStore(self._columns_path(version))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save_columns(self, version, st_df):
+        """
+        persist the typed frame of the dataset `version` as a MappedStore; older versions are removed.
+        """
+        for item in os.listdir(self.cache_dirpath):
+            if item.startswith('columns-'):
+                shutil.rmtree(os.path.join(self.cache_dirpath, item), ignore_errors=True)
+        MappedStore.write(self._columns_path(version), st_df)
+
+    def prune(self, files):
+        """
+        drop entries whose source csv is no longer in the folder.
+        :param files: source csv paths currently present
+        :return:
+        """
+        keep = {os.path.abspath(f) for f in files}
+        stale = [path for path in self.manifest.keys() if path not in keep]
+        for path in stale:
+            entry = self.manifest.pop(path)
+            try:
+                os.remove(self._entry_path(path, entry['fmt']))
+            except OSError:
+                pass
+        if stale:
+            self._write_manifest()
+
+
+def _read_report(file):
+    """
+    parse one Brand Analytics csv into a str-typed frame (date excluded).
+    :param file:
+    :return: (date, report_df)
+    """
+    with open(file, 'r', encoding='UTF-8') as fp:
+        reader = csv.reader(fp, delimiter=',')
+        date = _parse_viewing_date(next(reader))
+        report_df = pd.read_csv(fp, engine='c', dtype=str, na_filter=False)
+    return date, report_df
+
+
+def _peak_rss_mb():
+    """
+    peak resident memory of this process so far, None if it cannot be measured on this platform.
+    """
+    if _has_module('resource'):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    if _has_module('psutil'):
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
+    return None
+
+
+def _count_rows(obj):
+    if isinstance(obj, CompactStore):
+        return len(obj.row_term)
+    if isinstance(obj, (pd.DataFrame, list, tuple, Mapping)):
+        return len(obj)
+    return None
+
+
+class StageProfiler:
+    """
+    分阶段计时：每个阶段记录耗时、处理行数、行/秒和进程峰值内存，结束时输出一行 JSON，
+    可同时追加到 json_path (JSON Lines)。给出 cprofile_path 时，最外层阶段用 cProfile 运行并把统计写到该文件。
+    """
+
+    def __init__(self, enabled=False, json_path=None, cprofile_path=None):
+        self.enabled = enabled
+        self.json_path = json_path
+        self.cprofile_path = cprofile_path
+        self.records = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        :return: the stage record; set record['rows'] inside the block to report throughput
+        """
+        if not self.enabled:
+            yield {}
+            return
+        depth = getattr(self._local, 'depth', 0)
+        profile = None
+        if depth == 0 and self.cprofile_path is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+        record = {'stage': name, 'depth': depth, 'rows': None}
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            self._local.depth = depth
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.cprofile_path)
+            rows = record['rows']
+            record.update({
+                'seconds': round(seconds, 4),
+                'rows_per_sec': round(rows / seconds, 1) if rows is not None and seconds > 0 else None,
+                'peak_rss_mb': _peak_rss_mb(),
+                'time': datetime.now().isoformat(timespec='seconds'),
+            })
+            self._emit(record)
+
+    def _emit(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self.records.append(record)
+            print(line)
+            if self.json_path is not None:
+                with open(self.json_path, 'a', encoding='UTF-8') as fp:
+                    fp.write(line + '\n')
+
+
+def _profiled(stage_name, count=None):
+    """
+    run the decorated SearchEngine method as a profiler stage.
+    :param count: (result, args) -> rows processed, defaults to the size of the result
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.stage(stage_name) as record:
+                result = func(self, *args, **kwargs)
+                if self.profiler.enabled:
+                    record['rows'] = count(result, args) if count is not None else _count_rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+class ResultCache:
+    """
+    查询结果缓存，key 为规范化后的查询加数据版本 (所有源文件指纹)，新增或修改周报后旧结果自然失效。
+    内存中按 LRU 淘汰，总大小不超过 max_bytes；attach_dir 之后结果同时写入磁盘，按最近使用时间淘汰到 max_disk_bytes 以内。
+    """
+    # bump when the layout or values of search results change, so persisted results are not served
+    RESULT_VERSION = 2
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dirpath = None
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def attach_dir(self, cache_dirpath):
+        os.makedirs(cache_dirpath, exist_ok=True)
+        self.cache_dirpath = cache_dirpath
+
+    @staticmethod
+    def make_key(by, param, mode, engine, version, *extra):
+        if isinstance(param, (str, int)):
+            param = [param]
+        query = [ResultCache.RESULT_VERSION, by, [str(p) for p in param], mode, engine, version,
+                 *[str(e) for e in extra]]
+        return hashlib.md5(json.dumps(query, ensure_ascii=False).encode('UTF-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dirpath, f'{key}.pickle')
+
+    def get(self, key):
+        """
+        :return: (bind_df, param_str) or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[0].copy(), entry[1]
+        if self.cache_dirpath is None:
+            return None
+        entry_path = self._entry_path(key)
+        try:
+            bind_df, param_str = pd.read_pickle(entry_path)
+            os.utime(entry_path)
+        except (OSError, ValueError, EOFError):
+            return None
+        self._put_memory(key, bind_df, param_str)
+        return bind_df.copy(), param_str
+
+    def _put_memory(self, key, bind_df, param_str):
+        nbytes = int(bind_df.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self.entries[key] = (bind_df.copy(), param_str, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def put(self, key, bind_df, param_str):
+        self._put_memory(key, bind_df, param_str)
+        if self.cache_dirpath is None:
+            return
+        try:
+            pd.to_pickle((bind_df, param_str), self._entry_path(key))
+            self._evict_disk()
+        except OSError as e:
+            print(f'写入结果缓存失败：{e}')
+
+    def _evict_disk(self):
+        items = []
+        for item in os.listdir(self.cache_dirpath):
+            item_path = os.path.join(self.cache_dirpath, item)
+            stat = os.stat(item_path)
+            items.append((stat.st_mtime, stat.st_size, item_path))
+        total = sum(size for _, size, _ in items)
+        for _, size, item_path in sorted(items):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(item_path)
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+# term matching by words rather than by the whole string
+TOKEN_MODES = ['all', 'any', 'fuzzy']
+
+
+def _stem(token):
+    """
+    crude plural folding, applied to terms and keywords alike: shoes -> shoe, boxes -> box, batteries -> battery.
+    """
+    if len(token) > 4 and token.endswith('ies'):
+        return token[:-3] + 'y'
+    if len(token) > 4 and token.endswith(('sses', 'xes', 'zes', 'ches', 'shes')):
+        return token[:-2]
+    if len(token) > 3 and token.endswith('s') and not token.endswith(('ss', 'us', 'is')):
+        return token[:-1]
+    return token
+
+
+def _tokenize(text):
+    return [_stem(token) for token in re.findall(r'\w+', text.lower())]
+
+
+def _add_tokens(tokens, term_id, term):
+    for token in set(_tokenize(term)):
+        tokens.setdefault(token, []).append(term_id)
+
+
+def _max_edit_distance(token):
+    """
+    edits a token of this length may take in fuzzy mode: none for short tokens, where one edit is another word.
+    """
+    if len(token) < 4:
+        return 0
+    return 1 if len(token) < 8 else 2
+
+
+def _within_edit_distance(a, b, max_distance):
+    """
+    optimal string alignment distance of a and b, a swap of adjacent letters counting as one edit, is at most
+    max_distance. rows stop as soon as every cell is over the bound.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return False
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return False
+        previous2, previous = previous, current
+    return previous[-1] <= max_distance
+
+
+def _intersect_sorted(postings):
+    """
+    intersect ascending posting lists, shortest first; each id of the running result is found by binary search
+    from where the previous one was, so long lists are never walked in full.
+    """
+    postings = sorted(postings, key=len)
+    result = postings[0]
+    for posting in postings[1:]:
+        matched, lo = [], 0
+        for term_id in result:
+            lo = bisect.bisect_left(posting, term_id, lo)
+            if lo == len(posting):
+                break
+            if posting[lo] == term_id:
+                matched.append(term_id)
+        result = matched
+        if not result:
+            break
+    return list(result)
+
+
+def _union_sorted(postings):
+    return [term_id for term_id, _ in itertools.groupby(heapq.merge(*postings))]
+
+
+class TermIndex:
+    """
+    search term 倒排索引：exact 用哈希表，loose 用 n-gram 倒排表求交后再做子串校验。
+    all/any/fuzzy 按词匹配，用 token -> term id 倒排表 (首次按词查询时建立)，posting list 升序，查询时求交或求并；
+    fuzzy 对索引中没有的词改用编辑距离内的词。
+    term id 按加入顺序分配，所以查询结果保持数据原有顺序。
+    """
+    GRAM = 3
+
+    def __init__(self, terms=()):
+        self.terms = []
+        self.term_ids = {}
+        self.grams = {}
+        self.tokens = None
+        self._fuzzy_postings = {}
+        self.add(terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _grams(self, text):
+        n = self.GRAM
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+    def add(self, terms):
+        for term in terms:
+            if term in self.term_ids:
+                continue
+            term_id = len(self.terms)
+            self.terms.append(term)
+            self.term_ids[term] = term_id
+            for gram in self._grams(term):
+                self.grams.setdefault(gram, []).append(term_id)
+            if self.tokens is not None:
+                _add_tokens(self.tokens, term_id, term)
+                self._fuzzy_postings = {}
+        return self
+
+    def token_postings(self):
+        """
+        built into a local dict and published with one assignment, so a concurrent reader sees either no token
+        index or a complete one. a server builds it up front under its write lock.
+        :return: token -> ascending term ids of the terms holding it
+        """
+        tokens = self.tokens
+        if tokens is None:
+            tokens = {}
+            for term_id, term in enumerate(self.terms):
+                _add_tokens(tokens, term_id, term)
+            self.tokens = tokens
+        return tokens
+
+    def _fuzzy_posting(self, tokens, token):
+        """
+        term ids of the indexed tokens within edit distance of a token the index does not hold.
+        :param tokens: the token postings the lookup started with
+        """
+        fuzzy_postings = self._fuzzy_postings
+        posting = fuzzy_postings.get(token)
+        if posting is None:
+            max_distance = _max_edit_distance(token)
+            near = [p for other, p in tokens.items() if _within_edit_distance(token, other, max_distance)]
+            posting = _union_sorted(near) if max_distance else []
+            fuzzy_postings[token] = posting
+        return posting
+
+    def _lookup_token_ids(self, kw, mode):
+        tokens = self.token_postings()
+        postings = []
+        for token in dict.fromkeys(_tokenize(kw)):
+            posting = tokens.get(token)
+            if posting is None and mode == 'fuzzy':
+                posting = self._fuzzy_posting(tokens, token)
+            if posting:
+                postings.append(posting)
+            elif mode != 'any':
+                return []
+        if not postings:
+            return []
+        return _union_sorted(postings) if mode == 'any' else _intersect_sorted(postings)
+
+    def lookup_ids(self, kw, mode):
+        """
+        :param kw: keyword
+        :param mode: 'exact' for equality, 'all' / 'any' for terms holding all / any of its words in any order,
+            plurals folded, 'fuzzy' like 'all' with misspelled words matched by edit distance,
+            anything else for substring match
+        :return: matched term ids in ascending order
+        """
+        if mode in TOKEN_MODES:
+            return self._lookup_token_ids(kw, mode)
+        if mode == 'exact':
+            term_id = self.term_ids.get(kw)
+            return [] if term_id is None else [term_id]
+        if len(kw) < self.GRAM:
+            return [i for i, term in enumerate(self.terms) if kw in term]
+        postings = []
+        for gram in self._grams(kw):
+            posting = self.grams.get(gram)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+        return [i for i in sorted(candidates) if kw in self.terms[i]]
+
+    def lookup(self, kw, mode):
+        return [self.terms[i] for i in self.lookup_ids(kw, mode)]
+
+
+class AsinIndex:
+    """
+    ASIN 倒排索引：asin -> [(term_id, date_id, order, click share, conversion share), ...]。
+    term id 和 date id 按首次出现顺序分配，与 python 引擎 st_dict 的遍历顺序一致。
+    """
+
+    def __init__(self):
+        self.terms = []
+        self.term_ids = {}
+        self.dates = []
+        self.date_ids = {}
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.postings)
+
+    def _intern(self, value, values, value_ids):
+        value_id = value_ids.get(value)
+        if value_id is None:
+            value_id = len(values)
+            values.append(value)
+            value_ids[value] = value_id
+        return value_id
+
+    def add(self, asin, st, date, order, click_share, conversion_share):
+        term_id = self._intern(st, self.terms, self.term_ids)
+        date_id = self._intern(date, self.dates, self.date_ids)
+        self.postings.setdefault(asin, []).append((term_id, date_id, order, click_share, conversion_share))
+
+    @classmethod
+    def from_st_dict(cls, st_dict):
+        index = cls()
+        for st, value in st_dict.items():
+            for date, date_data in value['data'].items():
+                asin_data = date_data['asin_data']
+                if not isinstance(asin_data, dict):
+                    continue
+                for asin, val in asin_data.items():
+                    index.add(asin, st, date, val['order'], val['click share'], val['conversion share'])
+        return index
+
+    @classmethod
+    def from_st_df(cls, st_df, asin_len=3):
+        return cls().add_st_df(st_df, asin_len)
+
+    def add_st_df(self, st_df, asin_len=3):
+        """
+        add the postings of rows in st_df column order (department, search term, rank, date, 3 x 4 asin columns).
+        """
+        terms = st_df.iloc[:, 1].to_numpy()
+        dates = st_df.iloc[:, 3].to_numpy()
+        slots = [st_df.iloc[:, [4 + r * 4, 6 + r * 4, 7 + r * 4]].to_numpy() for r in range(asin_len)]
+        for i in range(len(st_df)):
+            for r in range(asin_len):
+                asin, click_share, conversion_share = slots[r][i]
+                self.add(asin, terms[i], dates[i], r + 1, click_share, conversion_share)
+        return self
+
+    def lookup(self, asins):
+        """
+        :param asins: exact ASINs
+        :return: postings of all given ASINs
+        """
+        postings = []
+        for asin in asins:
+            postings.extend(self.postings.get(asin, []))
+        return postings
+
+    def lookup_rows(self, asins):
+        """
+        :param asins: exact ASINs
+        :return: (search term, date) rows containing any of the ASINs, in st_dict order
+        """
+        row_ids = sorted({(p[0], p[1]) for p in self.lookup(asins)})
+        return [(self.terms[term_id], self.dates[date_id]) for term_id, date_id in row_ids]
+
+
+def _iter_report_chunks(file, chunksize, usecols=None):
+    """
+    read one Brand Analytics csv in chunks of str-typed rows.
+    :return: generator of (date, chunk_df)
+    """
+    with open(file, 'r', encoding='UTF-8') as fp:
+        reader = csv.reader(fp, delimiter=',')
+        date = _parse_viewing_date(next(reader))
+        for chunk_df in pd.read_csv(fp, engine='c', dtype=str, na_filter=False, usecols=usecols, chunksize=chunksize):
+            yield date, chunk_df
+
+
+def _read_rank_prefix(file, max_rank, chunksize):
+    """
+    terms ranked within max_rank in one report. reports are ordered by search frequency rank,
+    so parsing stops at the first chunk that goes past max_rank.
+    """
+    terms = []
+    chunksize = min(chunksize, max(max_rank, 1000))
+    for date, chunk_df in _iter_report_chunks(file, chunksize, usecols=range(1, 3)):
+        ranks = pd.to_numeric(chunk_df.iloc[:, 1].str.replace(',', ''))
+        terms.extend(chunk_df.iloc[:, 0][ranks <= max_rank])
+        if len(ranks) and ranks.iloc[-1] > max_rank:
+            break
+    return terms
+
+
+def _read_report_filtered(file, cache, chunksize, load_filter):
+    """
+    read one report chunk by chunk and keep only the rows passing load_filter.
+    a cached report is filtered as a whole; uncached reports are not written to the cache
+    because the full file is never held in memory.
+    :return: filtered frame with the date column inserted
+    """
+    cached = cache.get(file) if cache is not None else None
+    if cached is not None:
+        date, report_df = cached
+        usecols = load_filter.usecols()
+        if usecols is not None:
+            report_df = report_df.iloc[:, list(usecols)]
+        chunks = [load_filter.apply(report_df)]
+    else:
+        chunks = []
+        date = None
+        for date, chunk_df in _iter_report_chunks(file, chunksize, usecols=load_filter.usecols()):
+            chunks.append(load_filter.apply(chunk_df))
+    df_el = pd.concat(chunks, ignore_index=True)
+    df_el.insert(loc=3, column='date', value=date)
+    return df_el
+
+
+def _parse_share(share):
+    try:
+        return float(share.rstrip('%').replace(',', ''))
+    except ValueError:
+        return float('nan')
+
+
+def _format_share(share):
+    return '' if share != share else f'{share:.2f}%'
+
+
+def _format_shares(shares):
+    """
+    _format_share over the float32 share columns of a typed frame, str columns pass through.
+    shares take few distinct values, each is formatted once.
+    """
+    shares = np.asarray(shares)
+    if not np.issubdtype(shares.dtype, np.floating):
+        return shares
+    values, inverse = np.unique(shares, return_inverse=True)
+    return np.array([_format_share(float(v)) for v in values], dtype=object)[inverse.reshape(shares.shape)]
+
+
+def _share_values(shares):
+    """
+    float64 shares at the 2-decimal precision of the report: the values _parse_share reads back from
+    _format_share, so both engines add up the same numbers.
+    """
+    shares = np.asarray(shares)
+    values, inverse = np.unique(shares, return_inverse=True)
+    if np.issubdtype(shares.dtype, np.floating):
+        # typed frames: round trip each distinct float once instead of sorting the formatted strings again
+        values = [_format_share(float(v)) for v in values]
+    return np.array([_parse_share(v) for v in values], dtype=np.float64)[inverse.reshape(shares.shape)]
+
+
+def _excel_value(value):
+    """
+    a result cell as xlsxwriter's write() takes it: numpy scalars as python ones, missing values as None (left empty).
+    """
+    if isinstance(value, (list, tuple, dict, set)):
+        return str(value)
+    if pd.isna(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _widen_ints(values):
+    """
+    int32 values of a typed frame as int64 in result frames, matching the python engine output.
+    """
+    values = np.asarray(values)
+    return values.astype(np.int64) if np.issubdtype(values.dtype, np.integer) else values
+
+
+def _type_report_frame(report_df):
+    """
+    numeric columns of one str-typed report frame (date inserted): int32 rank, float32 click and conversion
+    shares in percent, NaN for empty shares like _parse_share.
+    """
+    if len(report_df.columns) > 2:
+        report_df[report_df.columns[2]] = pd.to_numeric(report_df.iloc[:, 2].str.replace(',', '')).astype(np.int32)
+    for r in range(3 if len(report_df.columns) > 4 else 0):
+        for i in [6 + r * 4, 7 + r * 4]:
+            shares = report_df.iloc[:, i].str.rstrip('%').str.replace(',', '')
+            report_df[report_df.columns[i]] = pd.to_numeric(shares, errors='coerce').astype(np.float32)
+    return report_df
+
+
+def _categorize(st_df, prev_df=None):
+    """
+    department, date and the clicked ASIN slots as categoricals, the 3 slots sharing one category set so
+    they compare by code. with prev_df the categories extend those of prev_df, which is recoded in place,
+    so the two frames concat as categoricals instead of falling back to object.
+    """
+    groups = [[0], [3]] + ([[4 + r * 4 for r in range(3)]] if len(st_df.columns) > 4 else [])
+    for group in groups:
+        categories = pd.Index(pd.unique(np.concatenate([st_df.iloc[:, i].to_numpy() for i in group])))
+        if prev_df is not None and isinstance(prev_df.iloc[:, group[0]].dtype, pd.CategoricalDtype):
+            known = prev_df.iloc[:, group[0]].cat.categories
+            categories = known.append(categories.difference(known))
+            if len(categories) > len(known):
+                for i in group:
+                    prev_df[prev_df.columns[i]] = prev_df.iloc[:, i].cat.set_categories(categories)
+        dtype = pd.CategoricalDtype(categories)
+        for i in group:
+            st_df[st_df.columns[i]] = st_df.iloc[:, i].astype(dtype)
+    return st_df
+
+
+def _asin_slot_codes(st_df, asin_len=3):
+    """
+    :return: ((rows, 3) int codes of the clicked ASIN slots, ASIN of each code). typed frames already hold
+        the codes, other frames are factorized
+    """
+    columns = [st_df.iloc[:, 4 + r * 4] for r in range(asin_len)]
+    if all(isinstance(c.dtype, pd.CategoricalDtype) and c.dtype == columns[0].dtype for c in columns):
+        return (np.column_stack([c.cat.codes.to_numpy() for c in columns]),
+                np.asarray(columns[0].cat.categories, dtype=object))
+    codes, uniques = pd.factorize(np.column_stack([c.to_numpy() for c in columns]).ravel())
+    return codes.reshape(-1, asin_len), np.asarray(uniques, dtype=object)
+
+
+class RowRecord:
+    """
+    view of one (term, week) row of a CompactStore, read like the old date_data dict.
+    """
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, key):
+        store = self.store
+        if key == 'search frequency rank':
+            return store.row_rank[self.row]
+        if key == 'asin_data':
+            return store.asin_data(self.row)
+        if key == 'filepath':
+            return store.date_files[store.row_date[self.row]]
+        raise KeyError(key)
+
+
+class TermRecord:
+    """
+    view of one term of a CompactStore, read like the old per-term dict.
+    min/avg/max rank are the only writable keys.
+    """
+    __slots__ = ('store', 'term_id')
+    RANK_KEYS = ('avg_rank', 'min_rank', 'max_rank')
+
+    def __init__(self, store, term_id):
+        self.store = store
+        self.term_id = term_id
+
+    def __getitem__(self, key):
+        store = self.store
+        if key == 'search_term':
+            return store.terms[self.term_id]
+        if key == 'site':
+            return store.sites[store.term_site[self.term_id]]
+        if key == 'data':
+            return store.term_data(self.term_id)
+        if key in self.RANK_KEYS:
+            return store.term_stats.get(self.term_id, {}).get(key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.RANK_KEYS:
+            raise KeyError(key)
+        self.store.term_stats.setdefault(self.term_id, {})[key] = value
+
+
+class CompactStore(Mapping):
+    """
+    python 引擎的紧凑存储，替代 {term: {..., 'data': {date: {..., 'asin_data': {...}}}}} 的嵌套字典。
+    term、site、date、ASIN、标题都驻留为整数 id，每个 (term, 周) 一行，rank 和 share 存在连续的 array 列中，
+    行按 term 排序，每个 term 的行区间由 CSR 风格的 offsets 给出。
+    对外仍是 term -> TermRecord 的映射，原有按字典读取的代码不用改。
+    """
+    ASIN_LEN = 3
+
+    def __init__(self):
+        self.terms, self.term_ids = [], {}
+        self.sites, self.site_ids = [], {}
+        self.dates, self.date_ids = [], {}
+        self.asins, self.asin_ids = [], {}
+        self.titles, self.title_ids = [], {}
+        self.date_files = []
+        self.term_site = array('I')
+        self.term_stats = {}
+        self.with_asin = False
+        self.row_term = array('I')
+        self.row_date = array('I')
+        self.row_rank = array('I')
+        self.row_asin = array('i')
+        self.row_title = array('i')
+        self.row_click = array('f')
+        self.row_conv = array('f')
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self._sorted_rows = 0
+
+    def _intern(self, value, values, value_ids):
+        value_id = value_ids.get(value)
+        if value_id is None:
+            value_id = len(values)
+            values.append(value)
+            value_ids[value] = value_id
+        return value_id
+
+    def add_row(self, site, st, date, rank, file, asin_slots=None):
+        """
+        :param asin_slots: [(asin, product title, click share, conversion share), ...], None for basic mode
+        """
+        term_id = self.term_ids.get(st)
+        if term_id is None:
+            term_id = self._intern(st, self.terms, self.term_ids)
+            self.term_site.append(self._intern(site, self.sites, self.site_ids))
+        date_id = self.date_ids.get(date)
+        if date_id is None:
+            date_id = self._intern(date, self.dates, self.date_ids)
+            self.date_files.append(file)
+        self.row_term.append(term_id)
+        self.row_date.append(date_id)
+        self.row_rank.append(rank)
+        if asin_slots is not None:
+            self.with_asin = True
+            for asin, title, click_share, conversion_share in asin_slots:
+                self.row_asin.append(self._intern(asin, self.asins, self.asin_ids))
+                self.row_title.append(self._intern(title, self.titles, self.title_ids))
+                self.row_click.append(_parse_share(click_share))
+                self.row_conv.append(_parse_share(conversion_share))
+
+    def finalize(self):
+        """
+        stable-sort newly added rows by term id and rebuild the offsets.
+        """
+        if self._sorted_rows == len(self.row_term):
+            return
+        row_term = np.frombuffer(self.row_term, dtype=np.uint32)
+        order = np.argsort(row_term, kind='stable')
+        for name in ['row_term', 'row_date', 'row_rank']:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, np.frombuffer(column, dtype=column.typecode).take(order).tobytes()))
+        if self.with_asin:
+            slot_order = (order[:, None] * self.ASIN_LEN + np.arange(self.ASIN_LEN)).ravel()
+            for name in ['row_asin', 'row_title', 'row_click', 'row_conv']:
+                column = getattr(self, name)
+                setattr(self, name,
+                        array(column.typecode, np.frombuffer(column, dtype=column.typecode).take(slot_order).tobytes()))
+        counts = np.bincount(np.frombuffer(self.row_term, dtype=np.uint32), minlength=len(self.terms))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self._sorted_rows = len(self.row_term)
+
+    def nbytes(self):
+        """
+        approximate memory held by the store, interned strings included.
+        """
+        columns = [self.term_site, self.row_term, self.row_date, self.row_rank, self.row_asin, self.row_title,
+                   self.row_click, self.row_conv]
+        nbytes = sum(c.buffer_info()[1] * c.itemsize for c in columns) + self.offsets.nbytes
+        for values in [self.terms, self.sites, self.dates, self.asins, self.titles]:
+            nbytes += sum(sys.getsizeof(v) for v in values)
+        return nbytes
+
+    def __getitem__(self, st):
+        term_id = self.term_ids[st]
+        return TermRecord(self, term_id)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, st):
+        return st in self.term_ids
+
+    def term_data(self, term_id):
+        self.finalize()
+        data = {}
+        for row in range(self.offsets[term_id], self.offsets[term_id + 1]):
+            data[self.dates[self.row_date[row]]] = RowRecord(self, row)
+        return data
+
+    def asin_data(self, row):
+        if not self.with_asin:
+            return []
+        asin_data_list = {}
+        for r in range(self.ASIN_LEN):
+            slot = row * self.ASIN_LEN + r
+            asin = self.asins[self.row_asin[slot]]
+            asin_data_list[asin] = {
+                'order': r + 1,
+                'clicked asin': asin,
+                'product title': self.titles[self.row_title[slot]],
+                'click share': _format_share(self.row_click[slot]),
+                'conversion share': _format_share(self.row_conv[slot]),
+            }
+        return asin_data_list
+
+    def rank_columns(self):
+        """
+        :return: (terms, dates, ranks) of every row, for vectorized aggregation
+        """
+        self.finalize()
+        row_term = np.frombuffer(self.row_term, dtype=np.uint32)
+        row_date = np.frombuffer(self.row_date, dtype=np.uint32)
+        terms = np.array(self.terms, dtype=object).take(row_term)
+        dates = np.array(self.dates, dtype=object).take(row_date)
+        return terms, dates, np.frombuffer(self.row_rank, dtype=np.uint32)
+
+
+class MappedStore:
+    """
+    pandas 引擎数据集的列式缓存：每列一个 .npy 文件，以 mmap 方式打开，字符串列存为整数编码加一份取值表。
+    行保持周报的读取顺序，每个日期分区是一段连续的行，查询只读取用到的列、日期分区和可能返回的行所在的页面。
+    """
+    META = 'meta.json'
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        with open(os.path.join(dirpath, self.META), 'r', encoding='UTF-8') as fp:
+            meta = json.load(fp)
+        self.rows = meta['rows']
+        self.columns = meta['columns']
+        self.partitions = meta['partitions']
+        self._arrays = {}
+        self._categories = {}
+        self._dtypes = {}
+
+    @classmethod
+    def write(cls, dirpath, st_df):
+        """
+        :param st_df: typed frame from _finalize_st_df. categorical columns keep their codes and share category
+            files when their categories are equal, str columns are factorized, numeric columns are saved as they are.
+        """
+        tmp_dirpath = dirpath + '.tmp'
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+        os.makedirs(tmp_dirpath)
+        columns, category_files = [], []
+        for i, name in enumerate(st_df.columns):
+            series = st_df.iloc[:, i]
+            column = {'name': name}
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                column['kind'], values, categories = 'category', series.cat.codes.to_numpy(), series.cat.categories
+            elif pd.api.types.is_numeric_dtype(series.dtype):
+                column['kind'], values, categories = 'values', series.to_numpy(), None
+            else:
+                codes, uniques = pd.factorize(series)
+                column['kind'], values, categories = 'strings', codes.astype(np.int32), pd.Index(uniques)
+            if categories is not None:
+                file = next((f for f, c in category_files if c.equals(categories) and c.dtype == categories.dtype),
+                            None)
+                if file is None:
+                    file = f'{i}.categories.pickle'
+                    pd.to_pickle(categories, os.path.join(tmp_dirpath, file))
+                    category_files.append((file, categories))
+                column['categories'] = file
+            np.save(os.path.join(tmp_dirpath, f'{i}.npy'), values)
+            columns.append(column)
+        partitions = []
+        if len(st_df) and 'date' in st_df.columns:
+            dates = st_df['date']
+            codes = pd.factorize(dates)[0]
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+            stops = np.concatenate([starts[1:], [len(st_df)]])
+            partitions = [[dates.iloc[start], int(start), int(stop)] for start, stop in zip(starts, stops)]
+        with open(os.path.join(tmp_dirpath, cls.META), 'w', encoding='UTF-8') as fp:
+            json.dump({'rows': len(st_df), 'columns': columns, 'partitions': partitions}, fp, ensure_ascii=False)
+        shutil.rmtree(dirpath, ignore_errors=True)
+        os.replace(tmp_dirpath, dirpath)
+
+    def __len__(self):
+        return self.rows
+
+    def array(self, i):
+        """
+        :return: memory-mapped values or codes of column i
+        """
+        values = self._arrays.get(i)
+        if values is None:
+            values = np.load(os.path.join(self.dirpath, f'{i}.npy'), mmap_mode='r')
+            self._arrays[i] = values
+        return values
+
+    def categories(self, i):
+        """
+        :return: Index of the values the codes of column i point to
+        """
+        file = self.columns[i]['categories']
+        categories = self._categories.get(file)
+        if categories is None:
+            categories = pd.read_pickle(os.path.join(self.dirpath, file))
+            self._categories[file] = categories
+        return categories
+
+    def _dtype(self, i):
+        file = self.columns[i]['categories']
+        dtype = self._dtypes.get(file)
+        if dtype is None:
+            dtype = pd.CategoricalDtype(self.categories(i))
+            self._dtypes[file] = dtype
+        return dtype
+
+    def _take(self, i, rows):
+        return np.asarray(self.array(i)[rows])
+
+    def nbytes(self):
+        """
+        memory held outside the mapped files: the loaded category and string values.
+        """
+        return sum(int(c.memory_usage(deep=True)) for c in self._categories.values())
+
+    def terms(self):
+        return self.categories(1)
+
+    def rank_columns(self):
+        """
+        :return: (terms, dates, ranks) of every row, for vectorized aggregation
+        """
+        terms = self.categories(1).take(self.array(1)).to_numpy()
+        dates = self.categories(3).take(self.array(3)).to_numpy()
+        return terms, dates, np.asarray(self.array(2))
+
+    def select_rows(self, load_filter=None, dates=None):
+        """
+        rows of the given date partitions that load_filter can return, decided on the codes only.
+        :param dates: date labels, None for every partition
+        :return: row numbers in ascending order
+        """
+        rows = [np.arange(start, stop) for date, start, stop in self.partitions if dates is None or date in dates]
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        if load_filter is None:
+            return rows
+        if load_filter.terms is not None:
+            matched = load_filter.term_mask(pd.Series(self.categories(1))).to_numpy(dtype=bool)
+            return rows[matched[self._take(1, rows)]]
+        if load_filter.max_rank is not None:
+            term_codes = self._take(1, rows)
+            candidates = np.unique(term_codes[self._take(2, rows) <= load_filter.max_rank])
+            return rows[np.isin(term_codes, candidates)]
+        if load_filter.asins is not None and len(self.columns) > 4:
+            mask = np.zeros(len(rows), dtype=bool)
+            for r in range(3):
+                has_asin = self.categories(4 + r * 4).isin(load_filter.asins)
+                mask |= has_asin[self._take(4 + r * 4, rows)]
+            return rows[mask]
+        return rows
+
+    def frame(self, load_filter=None, dates=None):
+        """
+        typed st_df of the selected rows, as _finalize_st_df returns it; only the columns load_filter reads
+        are loaded, categorical columns keep the categories of the whole dataset.
+        :param load_filter: LoadFilter of the query, None for every row and column
+        :param dates: date labels, None for every partition
+        """
+        rows = self.select_rows(load_filter, dates)
+        n_columns = len(self.columns)
+        if load_filter is not None and load_filter.usecols() is not None:
+            n_columns = min(len(load_filter.usecols()) + 1, n_columns)
+        data = {}
+        for i, column in enumerate(self.columns[:n_columns]):
+            values = self._take(i, rows)
+            if column['kind'] == 'category':
+                values = pd.Categorical.from_codes(values, dtype=self._dtype(i))
+            elif column['kind'] == 'strings':
+                values = self.categories(i).take(values)
+            data[column['name']] = values
+        return pd.DataFrame(data)
+
+
+class LoadFilter:
+    """
+    查询条件下推到读取阶段：边读边丢弃查询不可能返回的行。
+    term 和 ASIN 条件逐行判断；rank 条件 (loose/exact/mean 针对所有周) 先读每个文件排名不超过阈值的开头部分，
+    得到候选 term 后再按 term 过滤，最终是否满足条件由查询时的 rank 统计决定。
+    """
+
+    def __init__(self, by, param, mode):
+        self.by = by
+        self.mode = mode
+        self.terms = None
+        self.max_rank = None
+        self.asins = None
+        if isinstance(param, (str, int)):
+            param = [param]
+        if by in ['search term', 'search term asin', 'search term detail', 'click share asin'] and mode != 'fuzzy':
+            # fuzzy matches words the keywords do not hold, so every term is read
+            terms = [str(p).lower() for p in param]
+            # a set for the per-row exact test, run2 sheets can hold tens of thousands of keywords
+            self.terms = frozenset(terms)
+            self._term_pattern = re.compile('|'.join(re.escape(t) for t in terms))
+            self._term_tokens = [set(tokens) for tokens in map(_tokenize, terms) if tokens]
+        elif by in ['search frequency rank', 'search frequency rank asin', 'search frequency rank detail']:
+            # a malformed threshold is left to the search to report
+            self.max_rank = int(param[0]) if str(param[0]).isdigit() else None
+        elif by in ['asin detail']:
+            self.asins = set(param)
+        elif by in ['brand share']:
+            self.asins = set(_read_brand_map(param))
+        self.rank_terms = None
+
+    @property
+    def needs_rank_pass(self):
+        return self.max_rank is not None and self.rank_terms is None
+
+    def usecols(self):
+        if self.by in ['search term', 'search frequency rank']:
+            return range(3)
+        return None
+
+    def term_mask(self, terms):
+        """
+        :param terms: Series of search terms
+        :return: boolean Series, True for the terms the query can match
+        """
+        if self.mode in TOKEN_MODES:
+            return terms.isin([term for term in pd.unique(terms) if self._token_match(term)])
+        st = terms.str.lower()
+        if self.mode == 'exact':
+            return st.isin(self.terms)
+        return st.str.contains(self._term_pattern.pattern, regex=True)
+
+    def _token_match(self, term):
+        tokens = set(_tokenize(term))
+        if self.mode == 'any':
+            return any(kw_tokens & tokens for kw_tokens in self._term_tokens)
+        return any(kw_tokens <= tokens for kw_tokens in self._term_tokens)
+
+    def apply(self, chunk_df):
+        """
+        :param chunk_df: str-typed rows in report column order
+        :return: the rows the query can return
+        """
+        if self.terms is not None:
+            return chunk_df[self.term_mask(chunk_df.iloc[:, 1])]
+        if self.rank_terms is not None:
+            return chunk_df[chunk_df.iloc[:, 1].isin(self.rank_terms)]
+        if self.asins is not None:
+            mask = chunk_df.iloc[:, 3].isin(self.asins)
+            for r in range(1, 3):
+                mask |= chunk_df.iloc[:, 3 + r * 4].isin(self.asins)
+            return chunk_df[mask]
+        return chunk_df
+
+    def accept(self, row):
+        """
+        row-wise version of apply for the python engine.
+        :param row: str fields in report column order
+        """
+        if self.terms is not None:
+            if self.mode in TOKEN_MODES:
+                return self._token_match(row[1])
+            st = row[1].lower()
+            if self.mode == 'exact':
+                return st in self.terms
+            return self._term_pattern.search(st) is not None
+        if self.rank_terms is not None:
+            return row[1] in self.rank_terms
+        if self.asins is not None:
+            return row[3] in self.asins or row[7] in self.asins or row[11] in self.asins
+        return True
+
+
+RANK_MODE_STAT = {
+    'loose': 'min_rank',
+    'exact': 'max_rank',
+    'mean': 'avg_rank',
+}
+
+# weekly share a term has to reach: in its best week, in every week, on average
+SHARE_MODE_STAT = {
+    'loose': 'max',
+    'exact': 'min',
+    'mean': 'mean',
+}
+
+# share rankings: (value, label) columns, the top_k is ordered by value descending, ties by label
+TOP_K_ORDER = {
+    'click share asin': ('click share', 'clicked asin'),
+    'conversion share term': ('conversion share', 'search_term'),
+}
+
+CLICK_SHARE_ASIN_COLUMNS = ['clicked asin', 'product title', 'search terms', 'term weeks', 'click share',
+                            'avg click share', 'conversion share']
+CONVERSION_SHARE_TERM_COLUMNS = ['site', 'search_term', 'min_rank', 'avg_rank', 'max_rank', 'weeks',
+                                 'conversion share']
+BRAND_SHARE_COLUMNS = ['brand', 'site', 'date', 'search terms', 'asins', 'click share', 'avg click share',
+                       'conversion share', 'avg conversion share']
+
+
+def _param_str(by, param):
+    """
+    short label of a query param for result file names, kept with the cached result.
+    """
+    if by in ['brand share']:
+        return f'{len(set(_read_brand_map(param).values()))}brands'
+    if isinstance(param, (str, int, float)):
+        param = [param]
+    if 'rank' in by or by in ['conversion share term']:
+        return str(param[0])
+    return param[0] + '++'
+
+
+def _read_brand_map(param):
+    """
+    :param param: {asin: brand}, the path of a csv/xlsx file whose first two columns are ASIN and brand,
+        or a list of 'ASIN=brand' strings (one param cell per ASIN) or holding one of the above
+    :return: {asin: brand}
+    """
+    if isinstance(param, (list, tuple)) and len(param) == 1 and not str(param[0]).count('='):
+        param = param[0]
+    if isinstance(param, Mapping):
+        return {str(asin).strip(): str(brand).strip() for asin, brand in param.items()}
+    if isinstance(param, str):
+        if os.path.splitext(param)[1].lower() in ['.xlsx', '.xls']:
+            map_df = pd.read_excel(param, dtype=str)
+        else:
+            map_df = pd.read_csv(param, dtype=str)
+        map_df = map_df.iloc[:, :2].dropna()
+        return dict(zip(map_df.iloc[:, 0].str.strip(), map_df.iloc[:, 1].str.strip()))
+    brand_map = {}
+    for item in param:
+        asin, sep, brand = str(item).partition('=')
+        if not sep:
+            exit(f'ASIN 品牌对应格式应为 ASIN=品牌：{item}')
+        brand_map[asin.strip()] = brand.strip()
+    return brand_map
+
+
+def _brand_share_table(slots):
+    """
+    per brand, site and week: distinct terms and ASINs of the brand, its click and conversion shares summed over
+    those terms, and their average per term.
+    :param slots: long ASIN table, one row per (search term, date, clicked ASIN) of a mapped ASIN with
+        brand, site, date, search term, clicked asin, click share and conversion share columns
+    """
+    if slots.empty:
+        return pd.DataFrame(columns=BRAND_SHARE_COLUMNS)
+    table = slots.groupby(['brand', 'site', 'date'], sort=False, observed=True).agg(**{
+        'search terms': ('search term', 'nunique'),
+        'asins': ('clicked asin', 'nunique'),
+        'click share': ('click share', 'sum'),
+        'conversion share': ('conversion share', 'sum'),
+    }).reset_index()
+    for key in ['brand', 'site', 'date']:
+        table[key] = table[key].to_numpy(dtype=object)
+    for key in ['click share', 'conversion share']:
+        table[f'avg {key}'] = _round_share(table[key] / table['search terms'])
+        table[key] = _round_share(table[key])
+    table['start'] = table['date'].map(_report_start_date)
+    table = table.sort_values(['brand', 'site', 'start', 'date'], kind='stable', na_position='last')
+    return table[BRAND_SHARE_COLUMNS].reset_index(drop=True)
+
+
+def _round_share(share):
+    return np.round(share, 4)
+
+
+def _share_stat(shares, mode):
+    if mode == 'exact':
+        return min(shares)
+    if mode == 'mean':
+        return sum(shares) / len(shares)
+    return max(shares)
+
+
+def _top_k_order(values, labels, k):
+    """
+    positions of the k largest values, ties broken by label, the same selection as
+    heapq.nsmallest(k, key=lambda i: (-values[i], labels[i])). np.argpartition finds the k-th largest value
+    in one pass, only the candidates at or above it are sorted.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if len(values) > k:
+        kth = values[np.argpartition(-values, k - 1)[k - 1]]
+        candidates = np.nonzero(values >= kth)[0]
+    else:
+        candidates = np.arange(len(values))
+    return np.array(sorted(candidates, key=lambda i: (-values[i], labels[i]))[:k], dtype=np.int64)
+
+
+def _report_start_date(date):
+    return pd.to_datetime(str(date).split(' - ')[0].strip(), errors='coerce')
+
+
+def _report_date_range(date):
+    """
+    :param date: Viewing label of a report, 'M/D/YY - M/D/YY'
+    :return: (first day, last day), NaT when the label cannot be parsed
+    """
+    return _report_start_date(date), pd.to_datetime(str(date).split(' - ')[-1].strip(), errors='coerce')
+
+
+def _date_code_map(dates, code_map=None):
+    """
+    chronological week number of date labels; unparsable labels are numbered after the rest in order of appearance.
+    with the code_map of already numbered dates, new dates are numbered after them if they are all later,
+    otherwise None is returned and the caller has to renumber everything.
+    :param dates: date labels
+    :param code_map: {date: code} of the dates already numbered
+    :return: {date: code}
+    """
+    unique_dates = [d for d in pd.unique(pd.Series(dates)) if code_map is None or d not in code_map]
+    starts = [_report_start_date(d) for d in unique_dates]
+    order = sorted(range(len(unique_dates)), key=lambda i: (pd.isna(starts[i]), starts[i] if not pd.isna(starts[i]) else i))
+    if code_map is None:
+        return {unique_dates[i]: code for code, i in enumerate(order)}
+    known_starts = [_report_start_date(d) for d in code_map.keys()]
+    latest = max([d for d in known_starts if not pd.isna(d)], default=None)
+    if latest is not None and any(pd.isna(starts[i]) or starts[i] <= latest for i in order):
+        return None
+    code_map = dict(code_map)
+    for i in order:
+        code_map[unique_dates[i]] = len(code_map)
+    return code_map
+
+
+def _report_period(date, freq):
+    start = _report_start_date(date)
+    return None if pd.isna(start) else start.to_period(freq)
+
+
+def _rank_agg(terms, dates, ranks, code_map, freq=None):
+    """
+    per-term sums the rank stats are derived from; two of them can be merged with _merge_rank_agg.
+    :param freq: 'M' or 'Q' to aggregate per (period, search term) instead, a week belongs to the period of
+        its first day and weeks with an unparsable date are left out
+    """
+    ranks = pd.to_numeric(pd.Series(ranks))
+    if pd.api.types.is_integer_dtype(ranks):
+        # int32/uint32 rank columns are widened so the sums cannot overflow
+        ranks = ranks.astype(np.int64)
+    rank_df = pd.DataFrame({'search term': terms, 'date': dates, 'rank': ranks})
+    rank_df['x'] = rank_df['date'].map(code_map)
+    rank_df['xy'] = rank_df['x'] * rank_df['rank']
+    rank_df['xx'] = rank_df['x'] * rank_df['x']
+    keys = 'search term'
+    if freq is not None:
+        periods = {date: _report_period(date, freq) for date in pd.unique(rank_df['date'])}
+        rank_df['period'] = rank_df['date'].map(periods)
+        rank_df = rank_df[rank_df['period'].notna()]
+        keys = ['period', 'search term']
+    return rank_df.groupby(keys, sort=False).agg(
+        min_rank=('rank', 'min'),
+        max_rank=('rank', 'max'),
+        weeks=('rank', 'size'),
+        sx=('x', 'sum'),
+        sy=('rank', 'sum'),
+        sxy=('xy', 'sum'),
+        sxx=('xx', 'sum'),
+    )
+
 
+def _merge_rank_agg(agg, new_agg=None, level=0):
+    """
+    merge rank aggregates of the same terms: two per-term aggregates, or the periods of a rollup with
+    level='search term'.
+    """
+    merged = (agg if new_agg is None else pd.concat([agg, new_agg])).groupby(level=level, sort=False)
+    return merged.agg({'min_rank': 'min', 'max_rank': 'max', 'weeks': 'sum', 'sx': 'sum', 'sy': 'sum',
+                       'sxy': 'sum', 'sxx': 'sum'})
+
+
+def _rank_stats_from_agg(agg):
+    n = agg['weeks']
+    denom = n * agg['sxx'] - agg['sx'] ** 2
+    rank_stats = agg[['min_rank', 'max_rank', 'weeks']].copy()
+    rank_stats.insert(1, 'avg_rank', agg['sy'] / n)
+    rank_stats['rank_trend'] = (n * agg['sxy'] - agg['sx'] * agg['sy']) / denom.where(denom != 0)
+    return rank_stats
+
+
+def _build_rank_stats(terms, dates, ranks):
+    """
+    per-term rank aggregates over all weeks, computed in one grouped pass.
+    rank_trend is the least-squares slope of rank per week, negative means the term is climbing.
+    :param terms: search term of every (term, week) row
+    :param dates: date of every row
+    :param ranks: search frequency rank of every row
+    :return: (rank_stats, rank_agg, code_map), rank_stats is indexed by search term in order of first appearance
+    """
+    code_map = _date_code_map(dates)
+    agg = _rank_agg(terms, dates, ranks, code_map)
+    return _rank_stats_from_agg(agg), agg, code_map
+
+
+ROLLUP_FREQS = ['Q', 'M']
+
+
+def _window_bounds(start, end):
+    return (pd.Timestamp(start) if start is not None else None,
+            pd.Timestamp(end) if end is not None else None)
+
+
+def _rollup_freq(start, end):
+    """
+    coarsest rollup whose periods exactly tile the window, None if the bounds are not on period edges.
+    """
+    for freq in ROLLUP_FREQS:
+        if start is not None and start != start.to_period(freq).start_time:
+            continue
+        if end is not None and end != end.to_period(freq).end_time.normalize():
+            continue
+        return freq
+    return None
+
+
+class SearchEngine:
     BA_ATTRS = [
         'Department',
         'Search Term',
@@ -36,13 +1525,46 @@ class SearchEngine:
         'asin detail',
         'search term detail',
         'search frequency rank detail',
+        'click share asin',
+        'conversion share term',
+        'brand share',
     ]
 
     AVAILABLE_MODE = ['loose', 'exact']
 
+    # bys that match search terms, they also take the TOKEN_MODES
+    TERM_BY = ['search term', 'search term asin', 'search term detail', 'click share asin']
+
     AVAILABLE_ENGINE = ['pandas', 'python']
 
-    def __init__(self, engine=None):
+    @classmethod
+    def available_modes(cls, by):
+        """
+        :return: the modes a by takes: rank and share thresholds also take 'mean', term matches the TOKEN_MODES
+        """
+        modes = cls.AVAILABLE_MODE + (TOKEN_MODES if by in cls.TERM_BY else [])
+        if 'rank' in by or by == 'conversion share term':
+            modes = modes + ['mean']
+        return modes
+
+    AVAILABLE_ASIN_SHAPE = ['wide', 'long']
+
+    AVAILABLE_OUTPUT_FORMAT = ['xlsx', 'csv', 'parquet']
+
+    EXCEL_MAX_ROWS = 1048575
+    EXCEL_MAX_SHEETS = 8
+    EXPORT_CHUNKSIZE = 100000
+
+    def __init__(self, engine=None, use_cache=True, streaming=False, chunksize=100000, workers=1, asin_shape='wide',
+                 output_format='xlsx', result_cache=None, profiler=None, top_k=50, lazy=False):
+        """
+        :param streaming: read csv files in chunks when loading for a single query, bypassing the parse cache
+        :param lazy: pandas engine with the parse cache: keep the dataset as a memory-mapped columnar copy in the
+            cache folder (MappedStore) instead of in memory; each query reads only the columns, weeks and rows it needs
+        :param result_cache: ResultCache shared by searches, None for a private in-memory one, False to disable
+        :param profiler: StageProfiler collecting per-stage timings, None to disable
+        :param top_k: rows returned by the share rankings ('click share asin', 'conversion share term')
+        """
         self.by = None
         self.params = None
         self.param_str = None
@@ -51,8 +1573,33 @@ class SearchEngine:
             self.engine = 'python'
         else:
             self.engine = engine
+        self.use_cache = use_cache
+        self.streaming = streaming
+        self.chunksize = chunksize
+        self.workers = workers
+        self.asin_shape = asin_shape
+        self.output_format = output_format
+        self.top_k = top_k
+        self.lazy = lazy
+        if result_cache is None:
+            result_cache = ResultCache()
+        self.result_cache = result_cache or None
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+        self.load_filter = None
         self.st_data = None
         self.bind_df = None
+        self.term_index = None
+        self._term_index_key = None
+        self.asin_index = None
+        self._asin_index_key = None
+        self.rank_stats = None
+        self._rank_stats_key = None
+        self.report_cache = None
+        self.dataset_version = None
+        self.loaded = None
+        self._rank_agg = None
+        self._date_code_map = None
+        self._rank_rollups = {}
 
     def _get_columns_index(self, kw, columns):
         for i, c in enumerate(columns):
@@ -64,7 +1611,7 @@ class SearchEngine:
         return datetime.now().strftime('%Y%m%d-%H%M%S')
 
     def _get_abs_files_data(self, dirpath):
-        files_dict = {'csv': None, 'hdf': None, 'json': None}
+        files_dict = {'dirpath': dirpath, 'csv': None, 'hdf': None, 'json': None}
         item_list = os.listdir(dirpath)
         abs_file_list = []
         hdf_flag = False
@@ -83,91 +1630,58 @@ class SearchEngine:
         files_dict['csv'] = abs_file_list
         return files_dict
 
-    def _load_st_data_basic_mode(self, engine, reader, fp, file, st_data, date):
+    def _load_st_data_basic_mode(self, engine, reader, fp, file, st_data, date, report_df=None, load_filter=None):
         if engine in ['pandas']:
-            df_el = pd.read_csv(fp, engine='c', dtype=str, na_filter=False, usecols=range(3))
+            if report_df is None:
+                df_el = pd.read_csv(fp, engine='c', dtype=str, na_filter=False, usecols=range(3))
+            else:
+                # shallow: inserting the date and retyping columns later replace columns, the report is untouched
+                df_el = report_df.iloc[:, :3].copy(deep=False)
+            if load_filter is not None:
+                df_el = load_filter.apply(df_el)
             df_el.insert(loc=3, column='date', value=date)
-            st_data = st_data.append(df_el)
+            st_data.append(df_el)
         else:
             next(reader)
             i = 0
             for row in reader:
                 i += 1
-                st = row[1]
-                asin_data_list = []
-                date_data = {
-                    'filepath': file,
-                    'search frequency rank': i,
-                    'asin_data': asin_data_list
-                }
-                if st not in st_data.keys():
-                    site = row[0]
-                    st_data[st] = {
-                        'site': site,
-                        'search_term': st,
-                        'avg_rank': None,
-                        'min_rank': None,
-                        'max_rank': None,
-                    }
-                    st_data[st]['data'] = {
-                        date: date_data,
-                    }
-                else:
-                    st_data[st]['data'][date] = date_data
+                if load_filter is not None and not load_filter.accept(row):
+                    continue
+                st_data.add_row(row[0], row[1], date, i, file)
         return st_data
 
-    def _load_st_data_asin_mode(self, engine, reader, fp, file, st_data, date):
+    def _load_st_data_asin_mode(self, engine, reader, fp, file, st_data, date, report_df=None, load_filter=None):
         if engine in ['pandas']:
-            df_el = pd.read_csv(fp, engine='c', dtype=str, na_filter=False, usecols=None)
+            if report_df is None:
+                df_el = pd.read_csv(fp, engine='c', dtype=str, na_filter=False, usecols=None)
+            else:
+                df_el = report_df.copy(deep=False)
+            if load_filter is not None:
+                df_el = load_filter.apply(df_el)
             df_el.insert(loc=3, column='date', value=date)
-            st_data = st_data.append(df_el)
+            st_data.append(df_el)
         else:
             next(reader)
             i = 0
             for row in reader:
                 i += 1
-                st = row[1]
-                asin_data_list = {}
+                if load_filter is not None and not load_filter.accept(row):
+                    continue
                 # this below is difference.
-                for r in range(3):
-                    asin = row[3 + r * 4]
-                    asin_data_list[asin] = {
-                        'order': r + 1,
-                        'clicked asin': asin,
-                        'product title': row[4 + r * 4],
-                        'click share': row[5 + r * 4],
-                        'conversion share': row[6 + r * 4],
-                    }
+                asin_slots = [row[3 + r * 4:7 + r * 4] for r in range(3)]
                 # ............................
-                date_data = {
-                    'filepath': file,
-                    'search frequency rank': i,
-                    'asin_data': asin_data_list
-                }
-                if st not in st_data.keys():
-                    site = row[0]
-                    st_data[st] = {
-                        'site': site,
-                        'search_term': st,
-                        'avg_rank': None,
-                        'min_rank': None,
-                        'max_rank': None,
-                    }
-                    st_data[st]['data'] = {
-                        date: date_data,
-                    }
-                else:
-                    st_data[st]['data'][date] = date_data
+                st_data.add_row(row[0], row[1], date, i, file, asin_slots)
         return st_data
 
-    def _load_st_data_detail_mode(self, engine, reader, fp, file, st_data, date):
-        return self._load_st_data_asin_mode(engine, reader, fp, file, st_data, date)
+    def _load_st_data_detail_mode(self, engine, reader, fp, file, st_data, date, report_df=None, load_filter=None):
+        return self._load_st_data_asin_mode(engine, reader, fp, file, st_data, date, report_df, load_filter)
 
-    def _load_st_data(self, by, engine, reader, fp, file, st_data, date):
+    def _load_st_data(self, by, engine, reader, fp, file, st_data, date, report_df=None, load_filter=None):
         if by in ['search term', 'search frequency rank']:
-            st_data = self._load_st_data_basic_mode(engine, reader, fp, file, st_data, date)
+            st_data = self._load_st_data_basic_mode(engine, reader, fp, file, st_data, date, report_df, load_filter)
         else:
-            st_data = self._load_st_data_asin_mode(engine, reader, fp, file, st_data, date)
+            st_data = self._load_st_data_asin_mode(engine, reader, fp, file, st_data, date, report_df, load_filter)
 
         return self._after_load_st_data(by, st_data)
 
@@ -178,63 +1692,387 @@ class SearchEngine:
         #             val['min_rank'] = min([v['search frequency rank'] for v in val['data'].values()])
         return st_data
 
-    def set_search_term_data(self, by, engine, abs_file_data, prev_data=None):
+    def _get_report_cache(self, abs_file_data):
+        if not self.use_cache or abs_file_data.get('dirpath') is None:
+            return None
+        try:
+            cache = ReportCache(os.path.join(abs_file_data['dirpath'], CACHE_DIRNAME))
+            if self.result_cache is not None and self.result_cache.cache_dirpath is None:
+                self.result_cache.attach_dir(os.path.join(cache.cache_dirpath, 'results'))
+            return cache
+        except OSError as e:
+            print(f'缓存目录不可用，不使用缓存：{e}')
+            return None
+
+    def _read_report_cached(self, cache, file):
+        cached = cache.get(file)
+        if cached is not None:
+            return cached
+        date, report_df = _read_report(file)
+        try:
+            cache.put(file, date, report_df)
+        except (OSError, ValueError, ImportError) as e:
+            print(f'写入缓存失败：{file}, {e}')
+        return date, report_df
+
+    def _rank_pass(self, abs_file_list, cache, load_filter):
+        """
+        first pass of a rank-filtered load: the terms ranked within the threshold in at least one week.
+        a term outside the threshold in every week has min, avg and max rank above it, so these candidates
+        cover every mode; the query then applies the exact condition on their full rank history.
+        only the head of each report is parsed, cached reports are sliced instead.
+        """
+        candidates = set()
+        for file in abs_file_list:
+            cached = cache.get(file) if cache is not None else None
+            if cached is not None:
+                report_df = cached[1]
+                ranks = pd.to_numeric(report_df.iloc[:, 2].str.replace(',', ''))
+                candidates.update(report_df.iloc[:, 1][ranks <= load_filter.max_rank])
+            else:
+                candidates.update(_read_rank_prefix(file, load_filter.max_rank, self.chunksize))
+        return candidates
+
+    def _load_st_data_streaming(self, file, cache, load_filter):
+        return _read_report_filtered(file, cache, self.chunksize, load_filter)
+
+    def _parallel_reports(self, abs_file_list, cache, load_filter):
+        """
+        parse reports in a process pool of self.workers processes.
+        cache lookups and writes stay in this process, workers only parse csv files.
+        at most 2 x workers files are in flight, so parsed reports the caller has not taken yet do not pile up.
+        :return: generator of (date, report_df) in file order; with load_filter, (None, filtered frame)
+        """
+        def submit(file):
+            if load_filter is not None:
+                return executor.submit(_read_report_filtered, file, cache, self.chunksize, load_filter)
+            if cache is not None and cache.has(file):
+                return None
+            return executor.submit(_read_report, file)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            files = iter(abs_file_list)
+            pending = deque((file, submit(file)) for file in itertools.islice(files, 2 * self.workers))
+            while pending:
+                file, future = pending.popleft()
+                next_file = next(files, None)
+                if next_file is not None:
+                    pending.append((next_file, submit(next_file)))
+                if future is None:
+                    yield self._read_report_cached(cache, file)
+                    continue
+                result = future.result()
+                del future
+                if load_filter is not None:
+                    yield None, result
+                    continue
+                date, report_df = result
+                if cache is not None:
+                    try:
+                        cache.put(file, date, report_df)
+                    except (OSError, ValueError, ImportError) as e:
+                        print(f'写入缓存失败：{file}, {e}')
+                yield date, report_df
+
+    def _finalize_st_df(self, frames, prev_df=None):
+        """
+        concatenate the per-file frames of the pandas engine once, apply the typed schema and normalize
+        column names: int32 rank, float32 shares, categorical department, date and clicked ASINs.
+        :param prev_df: loaded frame the result will be appended to, its categories are extended to match
+        """
+        st_data = pd.concat([_type_report_frame(f) for f in frames], ignore_index=True) if frames else pd.DataFrame()
+        # st_data.columns = [
+        #     'department',
+        #     'search term',
+        #     'search frequency rank',
+        #     'date',
+        #     'clicked asin 1',
+        #     'product title 1',
+        #     'click share 1',
+        #     'conversion share 1',
+        #     'clicked asin 2',
+        #     'product title 2',
+        #     'click share 2',
+        #     'conversion share 2',
+        #     'clicked asin 3',
+        #     'product title 3',
+        #     'click share 3',
+        #     'conversion share 3',
+        # ]
+        if len(st_data.columns) > 3:
+            st_data = _categorize(st_data, prev_df)
+        st_data.columns = [col.lower() for col in st_data.columns]
+        return st_data
+
+    @_profiled('load')
+    def set_search_term_data(self, by, engine, abs_file_data, prev_data=None, load_filter=None):
+        """
+        :param load_filter: LoadFilter of the coming query. rows the query cannot return are dropped while
+            the reports are parsed, so memory follows the result size; the loaded data then only serves that query.
+        """
         def prepare_st_data(p_data):
-            if p_data:
+            if p_data is not None:
                 return p_data
             else:
                 if engine == 'python':
-                    p_data = self.ST_DICT
-                    if p_data is None:
-                        p_data = {}
-                    return p_data
+                    return CompactStore()
                 else:
-                    return pd.DataFrame()
+                    return []
 
         hdf_file = abs_file_data['hdf']
-        json_file = abs_file_data['json']
 
+        self.report_cache = None
+        self.dataset_version = None
+        self.loaded = None
         if engine in ['pandas'] and hdf_file:
             print(f'loading hdf file: {hdf_file}')
             st_data = pd.read_hdf(hdf_file, mode='r')
-        elif engine in ['python'] and json_file:
-            st_data = None
         else:
             abs_file_list = abs_file_data['csv']
             lenfile = len(abs_file_list)
             st_data = prepare_st_data(prev_data)
-            for index, file in enumerate(abs_file_list):
-                print(f'processing {index + 1}/{lenfile}')
-                with open(file, 'r', encoding='UTF-8') as fp:
-                    reader = csv.reader(fp, delimiter=',')
-                    date = next(reader)[4].replace('Viewing=[', '').replace(']', '')
-                    st_data = self._load_st_data(by, engine, reader, fp, file, st_data, date)
-            if engine in ['pandas']:
-                # st_data.columns = [
-                #     'department',
-                #     'search term',
-                #     'search frequency rank',
-                #     'date',
-                #     'clicked asin 1',
-                #     'product title 1',
-                #     'click share 1',
-                #     'conversion share 1',
-                #     'clicked asin 2',
-                #     'product title 2',
-                #     'click share 2',
-                #     'conversion share 2',
-                #     'clicked asin 3',
-                #     'product title 3',
-                #     'click share 3',
-                #     'conversion share 3',
-                # ]
-                st_data.iloc[:, 2] = pd.to_numeric(st_data.iloc[:, 2].str.replace(',', ''))
-                st_data.columns = [col.lower() for col in st_data.columns]
-                # df_new['click share'] = pd.to_numeric(df_new['click share'].str.rstrip('%'),errors='coerce') / 100.0
-                # df_new['conversion share'] = pd.to_numeric(df_new['conversion share'].str.rstrip('%'),errors='coerce') / 100.0
+            cache = self._get_report_cache(abs_file_data)
+            self.report_cache = cache
+            self.dataset_version = _dataset_version(abs_file_list)
+            self.loaded = {
+                'by': by,
+                'engine': engine,
+                'abs_file_data': abs_file_data,
+                'fingerprints': {os.path.abspath(f): _file_fingerprint(f) for f in abs_file_list},
+            }
+            if cache is not None:
+                cache.prune(abs_file_data.get('all_csv', abs_file_list))
+            # the columnar copy is saved from a full load, so it serves every by
+            mapped = self.lazy and engine in ['pandas'] and cache is not None and load_filter is None \
+                and prev_data is None
+            load_by = 'asin detail' if mapped else by
+            store = cache.load_columns(self.dataset_version) if mapped else None
+            if store is not None:
+                print(f'opening {store.dirpath}')
+                st_data = store
+            else:
+                if engine in ['pandas']:
+                    st_data = [st_data] if isinstance(st_data, pd.DataFrame) else st_data
+                if load_filter is not None and load_filter.needs_rank_pass:
+                    print('scanning ranks.')
+                    load_filter.rank_terms = self._rank_pass(abs_file_list, cache, load_filter)
+                # chunked filtered reads skip the parse cache, so they are only used when it is off or not wanted
+                stream_filter = load_filter if engine in ['pandas'] and (self.streaming or cache is None) else None
+                if self.workers > 1 and lenfile > 1:
+                    for index, (file, (date, report_df)) in enumerate(
+                            zip(abs_file_list, self._parallel_reports(abs_file_list, cache, stream_filter))):
+                        print(f'processing {index + 1}/{lenfile}')
+                        if stream_filter is not None:
+                            st_data.append(report_df)
+                            continue
+                        reader = itertools.chain([list(report_df.columns)],
+                                                 report_df.itertuples(index=False, name=None))
+                        st_data = self._load_st_data(load_by, engine, reader, None, file, st_data, date, report_df,
+                                                     load_filter)
+                else:
+                    for index, file in enumerate(abs_file_list):
+                        print(f'processing {index + 1}/{lenfile}')
+                        if stream_filter is not None:
+                            st_data.append(self._load_st_data_streaming(file, cache, stream_filter))
+                        elif cache is None:
+                            with open(file, 'r', encoding='UTF-8') as fp:
+                                reader = csv.reader(fp, delimiter=',')
+                                date = _parse_viewing_date(next(reader))
+                                st_data = self._load_st_data(load_by, engine, reader, fp, file, st_data, date,
+                                                             load_filter=load_filter)
+                        else:
+                            date, report_df = self._read_report_cached(cache, file)
+                            reader = itertools.chain([list(report_df.columns)],
+                                                     report_df.itertuples(index=False, name=None))
+                            st_data = self._load_st_data(load_by, engine, reader, None, file, st_data, date, report_df,
+                                                         load_filter)
+                if engine in ['pandas']:
+                    st_data = self._finalize_st_df(st_data)
+                if mapped:
+                    try:
+                        cache.save_columns(self.dataset_version, st_data)
+                        st_data = cache.load_columns(self.dataset_version) or st_data
+                    except OSError as e:
+                        print(f'写入列式缓存失败：{e}')
         self.st_data = st_data
+        self.load_filter = load_filter
+        self.term_index = None
+        self.asin_index = None
+        self.rank_stats = None
+        self._rank_rollups = {}
+        if by in ['asin detail'] and not isinstance(st_data, MappedStore):
+            self.get_asin_index(st_data)
         return st_data
 
+    def get_term_index(self, st_data):
+        """
+        term index of the loaded dataset, built on first use and reused by later searches.
+        any other st_data, like the rows one lazy query read, gets an index of its own that is not kept.
+        :param st_data: st_dict (python engine) or st_df (pandas engine)
+        :return: TermIndex
+        """
+        shared = st_data is self.st_data
+        if shared and self.term_index is not None and self._term_index_key == id(st_data):
+            return self.term_index
+        if isinstance(st_data, pd.DataFrame):
+            terms = st_data['search term'].unique()
+        elif isinstance(st_data, MappedStore):
+            terms = st_data.terms()
+        else:
+            terms = st_data.keys()
+        term_index = TermIndex(terms)
+        if shared:
+            self.term_index = term_index
+            self._term_index_key = id(st_data)
+        return term_index
+
+    def get_rank_stats(self, st_data):
+        """
+        min/avg/max rank, weeks present and rank trend of every term in the loaded dataset.
+        :param st_data: st_dict (python engine) or st_df (pandas engine)
+        :return: DataFrame indexed by search term
+        """
+        if self.rank_stats is None or self._rank_stats_key != id(st_data):
+            self.rank_stats, self._rank_agg, self._date_code_map = _build_rank_stats(*self._rank_columns(st_data))
+            self._rank_stats_key = id(st_data)
+        return self.rank_stats
+
+    def _rank_columns(self, st_data):
+        """
+        :return: (terms, dates, ranks) of every (term, week) row
+        """
+        if isinstance(st_data, pd.DataFrame):
+            return (st_data['search term'].to_numpy(), st_data['date'].to_numpy(),
+                    st_data['search frequency rank'].to_numpy())
+        if isinstance(st_data, (CompactStore, MappedStore)):
+            return st_data.rank_columns()
+        terms, dates, ranks = [], [], []
+        for st, value in st_data.items():
+            for date, date_data in value['data'].items():
+                terms.append(st)
+                dates.append(date)
+                ranks.append(date_data['search frequency rank'])
+        return terms, dates, ranks
+
+    def _get_rollup_agg(self, st_data, freq):
+        key, agg = self._rank_rollups.get(freq, (None, None))
+        if agg is None or key != id(st_data):
+            self.get_rank_stats(st_data)
+            agg = _rank_agg(*self._rank_columns(st_data), self._date_code_map, freq=freq)
+            self._rank_rollups[freq] = (id(st_data), agg)
+        return agg
+
+    def get_rank_rollup(self, st_data, freq='Q'):
+        """
+        min/avg/max rank, weeks present and rank trend of every term per month ('M') or quarter ('Q'),
+        built once per loaded dataset; date-window searches on period edges are answered by merging these.
+        :return: DataFrame indexed by (period, search term)
+        """
+        return _rank_stats_from_agg(self._get_rollup_agg(st_data, freq))
+
+    def get_window(self, st_data, start=None, end=None):
+        """
+        weeks and rank stats of a date window. a week is in the window when its first day is; stats come from
+        the quarter or month rollups when the window starts and ends on their edges, otherwise from the weekly rows.
+        :param start: first day, anything pd.Timestamp accepts, None for unbounded
+        :param end: last day, None for unbounded
+        :return: {'dates': set of date labels, 'rank_stats': DataFrame indexed by search term}, None without bounds
+        """
+        if start is None and end is None:
+            return None
+        start, end = _window_bounds(start, end)
+        self.get_rank_stats(st_data)
+        dates = set()
+        for date in self._date_code_map:
+            first_day = _report_start_date(date)
+            if pd.notna(first_day) and (start is None or first_day >= start) and (end is None or first_day <= end):
+                dates.add(date)
+        freq = _rollup_freq(start, end)
+        if freq is not None:
+            rollup = self._get_rollup_agg(st_data, freq)
+            periods = rollup.index.get_level_values('period')
+            in_window = np.ones(len(rollup), dtype=bool)
+            if start is not None:
+                in_window &= periods.start_time >= start
+            if end is not None:
+                in_window &= periods.start_time <= end
+            agg = _merge_rank_agg(rollup[in_window], level='search term')
+        else:
+            terms, row_dates, ranks = self._rank_columns(st_data)
+            in_window = pd.Series(row_dates).isin(dates).to_numpy()
+            agg = _rank_agg(np.asarray(terms, dtype=object)[in_window], np.asarray(row_dates, dtype=object)[in_window],
+                            np.asarray(ranks)[in_window], self._date_code_map)
+        return {'dates': dates, 'rank_stats': _rank_stats_from_agg(agg)}
+
+    def _rank_filtered_terms(self, st_data, param, mode, window=None):
+        rank_stats = self.get_rank_stats(st_data) if window is None else window['rank_stats']
+        return rank_stats.index[rank_stats[RANK_MODE_STAT[mode]] <= param]
+
+    def _attach_rank_stats(self, st_data, st_dict, terms, window=None):
+        """
+        fill min/avg/max rank of each term's entry from the precomputed rank stats.
+        :param st_data: the loaded dataset the stats belong to
+        :param st_dict: dict holding the term entries
+        :param terms: matched terms, duplicates allowed
+        :param window: get_window result; entries are then copies holding the window's weeks and stats
+        :return: searched list of term entries
+        """
+        searched_list = []
+        if window is not None:
+            rank_stats = window['rank_stats']
+            for row in rank_stats.loc[[t for t in terms if t in rank_stats.index]].itertuples():
+                value = st_dict[row.Index]
+                searched_list.append({
+                    'site': value['site'],
+                    'search_term': value['search_term'],
+                    'min_rank': row.min_rank,
+                    'avg_rank': row.avg_rank,
+                    'max_rank': row.max_rank,
+                    'data': {date: v for date, v in value['data'].items() if date in window['dates']},
+                })
+            return searched_list
+        for row in self.get_rank_stats(st_data).loc[list(terms)].itertuples():
+            value = st_dict[row.Index]
+            value['min_rank'] = row.min_rank
+            value['avg_rank'] = row.avg_rank
+            value['max_rank'] = row.max_rank
+            searched_list.append(value)
+        return searched_list
+
+    def get_asin_index(self, st_data):
+        """
+        ASIN index of the loaded dataset. it is persisted next to the report cache and reloaded
+        as long as the source files are unchanged. any other st_data gets an index of its own that is not kept.
+        :param st_data: st_dict (python engine) or st_df (pandas engine), loaded with ASIN columns
+        :return: AsinIndex
+        """
+        shared = st_data is self.st_data
+        if shared and self.asin_index is not None and self._asin_index_key == id(st_data):
+            return self.asin_index
+        cache, version = self.report_cache, self.dataset_version
+        if self.load_filter is not None or not shared:
+            cache = None
+        asin_index = None
+        if cache is not None and version is not None:
+            asin_index = cache.load_index('asin_index', version)
+        if asin_index is None:
+            if isinstance(st_data, MappedStore):
+                asin_index = AsinIndex.from_st_df(st_data.frame())
+            elif isinstance(st_data, pd.DataFrame):
+                asin_index = AsinIndex.from_st_df(st_data)
+            else:
+                asin_index = AsinIndex.from_st_dict(st_data)
+            if cache is not None and version is not None:
+                try:
+                    cache.save_index('asin_index', version, asin_index)
+                except OSError as e:
+                    print(f'写入索引缓存失败：{e}')
+        if shared:
+            self.asin_index = asin_index
+            self._asin_index_key = id(st_data)
+        return asin_index
+
+    @_profiled('parse_search_list', count=lambda result, args: len(args[1]))
     def _parse_search_list(self, by, searched_list):
         """
         转为可以转为df的字典
@@ -257,36 +2095,9 @@ class SearchEngine:
                 binded_dict_list.append(bind_dict)
             return binded_dict_list
         elif by in ['search term asin', 'search frequency rank asin']:
-            df_st2 = pd.DataFrame()
-            asin_len = 3
-            for sd in searched_list:
-
-                bind_list_dict = {
-                    'site': [sd['site']] * asin_len,
-                    'search_term': [sd['search_term']] * asin_len,
-                    'min_rank': [sd['min_rank']] * asin_len,
-                    'avg_rank': [sd['avg_rank']] * asin_len,
-                    'max_rank': [sd['max_rank']] * asin_len,
-                    'order': [i + 1 for i in range(asin_len)],
-                }
-                # date_value_dict = {}
-                for date, value in sd['data'].items():
-                    asin_list = list(value['asin_data'].keys())
-                    # print(asin_list)
-                    # asin_list.append([]*(asin_len-len(asin_list)))
-                    asin_list_len = len(asin_list)
-                    if asin_list_len < asin_len:
-                        asin_list += [None] * (asin_len - asin_list_len)
-                    bind_list_dict[date] = asin_list
-                # for k,v in bind_list_dict.items():
-                #     print(f'{k}: {len(v)}')
-                df_temp = pd.DataFrame(bind_list_dict)
-                df_st2 = df_st2.append(df_temp, ignore_index=True)
-                # merge dict
-                # bind_dict = {**bind_dict, **date_value_dict}
-                # bind_dict_list.append(bind_dict)
-            df_st2.loc[:, 'site':'max_rank'] = df_st2.loc[:, 'site':'max_rank'].ffill()
-            return df_st2
+            if self.asin_shape == 'long':
+                return self._asin_result_long(searched_list)
+            return self._asin_result_wide(searched_list)
         else:
             binded_dict_list = []
             for sd in searched_list:
@@ -307,7 +2118,185 @@ class SearchEngine:
                         binded_dict_list.append(binded_dict)
             return binded_dict_list
 
-    def search_dict_mode(self, by, param, mode, st_dict):
+    @_profiled('refresh')
+    def refresh(self):
+        """
+        pick up new or changed csv files in the loaded folder.
+        new files are appended to the loaded data and the term index, ASIN index and rank stats are extended
+        with their rows only; a changed or removed file, or a query-filtered load, is reloaded from scratch.
+        :return: list of files (re)loaded
+        """
+        abs_file_data, current, changed, new_files = self._pending_files()
+        by, engine = self.loaded['by'], self.loaded['engine']
+        abs_file_list = abs_file_data['csv']
+        fingerprints = self.loaded['fingerprints']
+        if not changed and not new_files:
+            return []
+        if self._refresh_reloads(changed):
+            print('文件有改动，重新加载。')
+            if self.load_filter is not None:
+                self.load_filter.rank_terms = None
+            self.set_search_term_data(by, engine, abs_file_data, load_filter=self.load_filter)
+            return abs_file_list
+        self._append_reports(by, engine, new_files)
+        fingerprints.update({os.path.abspath(f): current[os.path.abspath(f)] for f in new_files})
+        self.loaded['abs_file_data'] = abs_file_data
+        self.dataset_version = _dataset_version(abs_file_list)
+        if self.asin_index is not None and self.report_cache is not None:
+            try:
+                self.report_cache.save_index('asin_index', self.dataset_version, self.asin_index)
+            except OSError as e:
+                print(f'写入索引缓存失败：{e}')
+        return new_files
+
+    def _pending_files(self):
+        """
+        :return: (abs_file_data of the loaded folder now, fingerprint of each of its csv files,
+            loaded files changed or removed since, files added since)
+        """
+        assert self.loaded is not None, 'no csv folder loaded.'
+        abs_file_data = self._get_abs_files_data(self.loaded['abs_file_data']['dirpath'])
+        fingerprints = self.loaded['fingerprints']
+        current = {os.path.abspath(f): _file_fingerprint(f) for f in abs_file_data['csv']}
+        changed = [path for path, fingerprint in fingerprints.items() if current.get(path) != fingerprint]
+        new_files = [f for f in abs_file_data['csv'] if os.path.abspath(f) not in fingerprints]
+        return abs_file_data, current, changed, new_files
+
+    def _refresh_reloads(self, changed):
+        return bool(changed) or self.load_filter is not None or isinstance(self.st_data, MappedStore)
+
+    def estimate_refresh_nbytes(self, nbytes):
+        """
+        size of the loaded data after refresh(), scaled from its current size by csv bytes, so a refresh can be
+        refused before anything is loaded.
+        :param nbytes: current size of the loaded data
+        :return: estimated size, nbytes when nothing changed
+        """
+        abs_file_data, current, changed, new_files = self._pending_files()
+        if not changed and not new_files:
+            return nbytes
+        loaded_bytes = sum(fingerprint['size'] for fingerprint in self.loaded['fingerprints'].values())
+        bytes_per_csv_byte = nbytes / loaded_bytes if loaded_bytes else 0
+        if self._refresh_reloads(changed):
+            return int(bytes_per_csv_byte * sum(fingerprint['size'] for fingerprint in current.values()))
+        new_bytes = sum(current[os.path.abspath(f)]['size'] for f in new_files)
+        return int(nbytes + bytes_per_csv_byte * new_bytes)
+
+    def _append_reports(self, by, engine, new_files):
+        """
+        append new report files to the loaded data and extend the built indexes and rank stats.
+        every report is parsed before anything is appended, so a file that fails to parse leaves the loaded data
+        as it was and the next refresh retries all of them.
+        """
+        st_data = self.st_data
+        n_terms = len(st_data) if isinstance(st_data, CompactStore) else None
+        reports = []
+        for index, file in enumerate(new_files):
+            print(f'processing {index + 1}/{len(new_files)}')
+            if self.report_cache is not None:
+                reports.append((file, *self._read_report_cached(self.report_cache, file)))
+            else:
+                reports.append((file, *_read_report(file)))
+        frames, rank_frames = [], []
+        for file, date, report_df in reports:
+            if engine in ['pandas']:
+                self._load_st_data(by, engine, None, None, file, frames, date, report_df)
+            else:
+                reader = itertools.chain([list(report_df.columns)], report_df.itertuples(index=False, name=None))
+                self._load_st_data(by, engine, reader, None, file, st_data, date, report_df)
+                report_df = report_df.copy()
+                report_df[report_df.columns[2]] = range(1, len(report_df) + 1)
+                report_df.insert(loc=3, column='date', value=date)
+                rank_frames.append(report_df)
+        if engine in ['pandas']:
+            new_df = self._finalize_st_df(frames, st_data)
+            self.st_data = pd.concat([st_data, new_df], ignore_index=True)
+            new_terms = new_df['search term'].unique()
+        else:
+            new_df = pd.concat(rank_frames, ignore_index=True)
+            new_df.columns = [col.lower() for col in new_df.columns]
+            new_terms = st_data.terms[n_terms:]
+        key = id(self.st_data)
+        if self.term_index is not None:
+            self.term_index.add(new_terms)
+            self._term_index_key = key
+        if self.asin_index is not None and len(new_df.columns) > 4:
+            self.asin_index.add_st_df(new_df)
+            self._asin_index_key = key
+        self._rank_rollups = {}
+        if self.rank_stats is not None:
+            code_map = _date_code_map(new_df['date'], self._date_code_map)
+            if code_map is None:
+                self.rank_stats = None
+            else:
+                new_agg = _rank_agg(*self._rank_columns(new_df), code_map)
+                self._rank_agg = _merge_rank_agg(self._rank_agg, new_agg)
+                self._date_code_map = code_map
+                self.rank_stats = _rank_stats_from_agg(self._rank_agg)
+                self._rank_stats_key = key
+
+    def watch(self, interval=60, on_update=None):
+        """
+        poll the loaded folder every `interval` seconds and refresh it, until Ctrl+C.
+        :param on_update: called with the list of (re)loaded files after each update
+        """
+        print(f'watching {self.loaded["abs_file_data"]["dirpath"]}')
+        try:
+            while True:
+                time.sleep(interval)
+                updated_files = self.refresh()
+                if updated_files:
+                    print(f'{len(updated_files)} file(s) loaded.')
+                    if on_update is not None:
+                        on_update(updated_files)
+        except KeyboardInterrupt:
+            print('stop watching.')
+
+    def _asin_result_wide(self, searched_list, asin_len=3):
+        """
+        one row per (term, order), one column per date holding the clicked asin.
+        columns are filled in a single pass; dates a term is missing are NaN.
+        """
+        if not searched_list:
+            return pd.DataFrame()
+        columns = {'site': [], 'search_term': [], 'min_rank': [], 'avg_rank': [], 'max_rank': [], 'order': []}
+        date_columns = {}
+        n = 0
+        for sd in searched_list:
+            for key in ['site', 'search_term', 'min_rank', 'avg_rank', 'max_rank']:
+                columns[key].extend([sd[key]] * asin_len)
+            columns['order'].extend(range(1, asin_len + 1))
+            for date, value in sd['data'].items():
+                asin_list = list(value['asin_data'].keys())[:asin_len]
+                asin_list += [None] * (asin_len - len(asin_list))
+                date_column = date_columns.get(date)
+                if date_column is None:
+                    date_column = date_columns[date] = [np.nan] * n
+                date_column.extend(asin_list)
+            n += asin_len
+            for date_column in date_columns.values():
+                if len(date_column) < n:
+                    date_column.extend([np.nan] * (n - len(date_column)))
+        return pd.DataFrame({**columns, **date_columns})
+
+    def _asin_result_long(self, searched_list):
+        """
+        one row per (term, date, order), unpivoted version of _asin_result_wide.
+        """
+        columns = {k: [] for k in ['site', 'search_term', 'min_rank', 'avg_rank', 'max_rank', 'date', 'order',
+                                   'clicked asin']}
+        for sd in searched_list:
+            base = [sd['site'], sd['search_term'], sd['min_rank'], sd['avg_rank'], sd['max_rank']]
+            for date, value in sd['data'].items():
+                for order, asin in enumerate(value['asin_data'].keys(), 1):
+                    for key, v in zip(['site', 'search_term', 'min_rank', 'avg_rank', 'max_rank'], base):
+                        columns[key].append(v)
+                    columns['date'].append(date)
+                    columns['order'].append(order)
+                    columns['clicked asin'].append(asin)
+        return pd.DataFrame(columns)
+
+    def search_dict_mode(self, by, param, mode, st_dict, window=None):
         bind_dict_list = []
         self.param_str = param
         condition = {
@@ -315,23 +2304,22 @@ class SearchEngine:
             'exact': lambda x, y, z: x == y,
             'mean': lambda x, y, z: x in z,
         }
-        assert isinstance(st_dict, dict) and len(st_dict) > 0, 'wrong data structure.'
+        assert isinstance(st_dict, Mapping), 'wrong data structure.'
         searched_list = []
         if by in ['search term', 'search term asin', 'search term detail']:
             if isinstance(param, str):
                 param = [param]
-            self.param_str = param[0] + '++'
+            self.param_str = _param_str(by, param)
+            term_index = self.get_term_index(st_dict)
+            matched_terms = []
             for par in param:
-                for st, value in st_dict.items():
-                    if condition[mode](par.lower(), st, st):
-                        sfr = [v['search frequency rank'] for v in value['data'].values()]
-                        _calc_rank(by, sfr, value)
-                        searched_list.append(value)
+                matched_terms.extend(term_index.lookup(par.lower(), mode))
+            searched_list = self._attach_rank_stats(st_dict, st_dict, matched_terms, window)
             bind_dict_list = self._parse_search_list(by, searched_list)
         elif by in ['search frequency rank', 'search frequency rank asin', 'search frequency rank detail']:
             if isinstance(param, str) or isinstance(param, int):
                 param = [param]
-            self.param_str = str(param[0])
+            self.param_str = _param_str(by, param)
             param = param[0]
             if isinstance(param, str) and param.isalnum():
                 param = int(param)
@@ -340,179 +2328,280 @@ class SearchEngine:
             else:
                 exit('param不是数字形式。')
 
-            if mode == 'loose':
-                for st, value in st_dict.items():
-                    sfr = [v['search frequency rank'] for v in value['data'].values()]
-                    min_rank = min(sfr)
-                    value['min_rank'] = min_rank
-                    if min_rank <= param:
-                        _calc_rank(by, sfr, value)
-                        searched_list.append(value)
-            elif mode == 'exact':
-                for st, value in st_dict.items():
-                    sfr = [v['search frequency rank'] for v in value['data'].values()]
-                    max_rank = max(sfr)
-                    value['max_rank'] = max_rank
-                    if max_rank <= param:
-                        _calc_rank(by, sfr, value)
-                        searched_list.append(value)
-            elif mode == 'mean':
-                for st, value in st_dict.items():
-                    sfr = [v['search frequency rank'] for v in value['data'].values()]
-                    avg_rank = sum(sfr) / len(sfr)
-                    value['avg_rank'] = avg_rank
-                    if avg_rank <= param:
-                        _calc_rank(by, sfr, value)
-                        searched_list.append(value)
+            matched_terms = self._rank_filtered_terms(st_dict, param, mode, window)
+            searched_list = self._attach_rank_stats(st_dict, st_dict, matched_terms, window)
             bind_dict_list = self._parse_search_list(by, searched_list)
         elif by in ['asin detail']:
             if isinstance(param, str):
                 param = [param]
-            self.param_str = param[0] + '++'
-            for st, value in st_dict.items():
-                for date, date_data in value['data'].items():
-                    asin_list = date_data['asin_data'].keys()
-                    for k, asin_data in date_data['asin_data'].items():
-                        for par in param:
-                            if condition[mode](par, k, asin_list):
-                                bind_dict = {
-                                    'site': value['site'],
-                                    'search_term': value['search_term'],
-                                    'search frequency rank': date_data['search frequency rank'],
-                                    'date': date,
-                                }
-                                bind_dict = {**bind_dict, **asin_data}
-                                # searched_list.append(value)
-                                bind_dict_list.append(bind_dict)
-                                break
+            self.param_str = _param_str(by, param)
+            for st, date in self.get_asin_index(st_dict).lookup_rows(param):
+                if window is not None and date not in window['dates']:
+                    continue
+                value = st_dict[st]
+                date_data = value['data'][date]
+                asin_list = date_data['asin_data'].keys()
+                for k, asin_data in date_data['asin_data'].items():
+                    for par in param:
+                        if condition[mode](par, k, asin_list):
+                            bind_dict = {
+                                'site': value['site'],
+                                'search_term': value['search_term'],
+                                'search frequency rank': date_data['search frequency rank'],
+                                'date': date,
+                            }
+                            bind_dict = {**bind_dict, **asin_data}
+                            # searched_list.append(value)
+                            bind_dict_list.append(bind_dict)
+                            break
+        elif by in ['click share asin']:
+            if isinstance(param, str):
+                param = [param]
+            self.param_str = _param_str(by, param)
+            term_index = self.get_term_index(st_dict)
+            matched_terms = set()
+            for par in param:
+                matched_terms.update(term_index.lookup(par.lower(), mode))
+            bind_dict_list = self._click_share_asins(st_dict, sorted(matched_terms), window)
+        elif by in ['conversion share term']:
+            threshold = self._share_threshold(param)
+            bind_dict_list = self._conversion_share_terms(st_dict, threshold, mode, window)
+        elif by in ['brand share']:
+            brand_map = self._brand_map_param(param)
+            bind_dict_list = self._brand_share_postings(st_dict, brand_map, window)
         bind_df = self.bind_list_to_df(bind_dict_list)
         self.bind_df = bind_df
         return bind_df
 
-    def df_row_to_st_dict_basic(self, row, st_dict, append_dict=None):
-        st = row[2]
-        asin_data_list = []
-        date = row[4]
-        date_data = {
-            'filepath': None,
-            'search frequency rank': row[3],
-            'asin_data': asin_data_list
-        }
-        if st not in st_dict.keys():
-            site = row[1]
-            st_dict[st] = {
-                'site': site,
-                'search_term': st,
-                'avg_rank': None,
-                'min_rank': None,
-                'max_rank': None,
-            }
-            st_dict[st]['data'] = {
-                date: date_data,
-            }
-            if append_dict:
-                for k, v in append_dict.items():
-                    st_dict[st][k] = row[v]
-        else:
-            st_dict[st]['data'][date] = date_data
+    def _share_threshold(self, param):
+        if isinstance(param, (str, int, float)):
+            param = [param]
+        self.param_str = _param_str('conversion share term', param)
+        try:
+            return float(str(param[0]).rstrip('%'))
+        except ValueError:
+            exit('param不是数字形式。')
 
-    def df_row_to_st_dict_extended(self, row, st_dict, append_dict=None):
-        st = row[2]
-        sfr = row[3]
-        date = row[4]
-        order = row[5]
-        asin_len = 3
+    def _brand_map_param(self, param):
+        brand_map = _read_brand_map(param)
+        self.param_str = _param_str('brand share', brand_map)
+        return brand_map
 
-        def _render_asin_data(row):
-            asin_data_list = {}
-            for i in range(1, asin_len + 1):
-                asin_index = 1 + i * 4
-                asin = row[asin_index]
-                asin_info = {
-                    'order': order,
-                    'clicked asin': asin,
-                    'product title': row[asin_index + 1],
-                    'click share': row[asin_index + 2],
-                    'conversion share': row[asin_index + 3],
-                }
-                asin_data_list[asin] = asin_info
-            return asin_data_list
+    def _brand_share_postings(self, st_dict, brand_map, window=None):
+        """
+        python engine: the long ASIN table of the mapped ASINs comes straight from the ASIN index postings,
+        then goes through the same group-by as the pandas engine.
+        """
+        asin_index = self.get_asin_index(st_dict)
+        columns = {k: [] for k in ['brand', 'site', 'date', 'search term', 'clicked asin', 'click share',
+                                   'conversion share']}
+        for asin, brand in brand_map.items():
+            # an index built from a frame has one posting per slot, a repeated ASIN keeps its last slot like asin_data
+            postings = {(p[0], p[1]): p for p in asin_index.postings.get(asin, [])}
+            for term_id, date_id, order, click_share, conversion_share in postings.values():
+                st, date = asin_index.terms[term_id], asin_index.dates[date_id]
+                if window is not None and date not in window['dates']:
+                    continue
+                columns['brand'].append(brand)
+                columns['site'].append(st_dict[st]['site'])
+                columns['date'].append(date)
+                columns['search term'].append(st)
+                columns['clicked asin'].append(asin)
+                columns['click share'].append(click_share)
+                columns['conversion share'].append(conversion_share)
+        for key in ['click share', 'conversion share']:
+            # postings hold report strings, or float32 shares when the index was built from a typed frame
+            shares = [_parse_share(share) if isinstance(share, str) else share for share in columns[key]]
+            columns[key] = _share_values(np.array(shares, dtype=np.float64))
+        return _brand_share_table(pd.DataFrame(columns))
+
+    def _click_share_asins(self, st_dict, terms, window=None):
+        """
+        python engine: the top_k clicked ASINs by click share summed over every week of the given terms,
+        selected with a heap.
+        """
+        totals = {}
+        for st in terms:
+            for date, date_data in st_dict[st]['data'].items():
+                if window is not None and date not in window['dates']:
+                    continue
+                for asin, asin_data in date_data['asin_data'].items():
+                    if not asin:
+                        continue
+                    total = totals.get(asin)
+                    if total is None:
+                        total = totals[asin] = {'product title': asin_data['product title'], 'search terms': set(),
+                                                'term weeks': 0, 'click share': 0.0, 'conversion share': 0.0}
+                    total['search terms'].add(st)
+                    total['term weeks'] += 1
+                    for key in ['click share', 'conversion share']:
+                        share = _parse_share(asin_data[key])
+                        if share == share:
+                            total[key] += share
+        top = heapq.nsmallest(self.top_k, totals.items(),
+                              key=lambda item: (-_round_share(item[1]['click share']), item[0]))
+        bind_dict_list = []
+        for asin, total in top:
+            bind_dict_list.append({
+                'clicked asin': asin,
+                'product title': total['product title'],
+                'search terms': len(total['search terms']),
+                'term weeks': total['term weeks'],
+                'click share': _round_share(total['click share']),
+                'avg click share': _round_share(total['click share'] / total['term weeks']),
+                'conversion share': _round_share(total['conversion share']),
+            })
+        return pd.DataFrame(bind_dict_list, columns=CLICK_SHARE_ASIN_COLUMNS)
 
-        if st not in st_dict.keys():
-            site = row[1]
-            st_dict[st] = {
-                'site': site,
+    def _conversion_share_terms(self, st_dict, threshold, mode, window=None):
+        """
+        python engine: the top_k terms whose weekly conversion share (summed over the clicked ASINs) reaches
+        threshold in their best week, every week or on average, selected with a heap.
+        """
+        passed = []
+        for st, value in st_dict.items():
+            shares = []
+            for date, date_data in value['data'].items():
+                if window is not None and date not in window['dates']:
+                    continue
+                total = 0.0
+                for asin_data in date_data['asin_data'].values():
+                    share = _parse_share(asin_data['conversion share'])
+                    if share == share:
+                        total += share
+                shares.append(total)
+            if shares:
+                share = _round_share(_share_stat(shares, mode))
+                if share >= threshold:
+                    passed.append((st, len(shares), share))
+        top = heapq.nsmallest(self.top_k, passed, key=lambda row: (-row[2], row[0]))
+        rank_stats = self.get_rank_stats(st_dict) if window is None else window['rank_stats']
+        bind_dict_list = []
+        for st, weeks, share in top:
+            stats = rank_stats.loc[st]
+            bind_dict_list.append({
+                'site': st_dict[st]['site'],
                 'search_term': st,
-                'avg_rank': None,
-                'min_rank': None,
-                'max_rank': None,
-            }
-            # this below is difference.
-            # ............................
-            date_data = {
-                'filepath': None,
-                'search frequency rank': sfr,
-                'asin_data': _render_asin_data(row)
-            }
-            st_dict[st]['data'] = {
-                date: date_data,
-            }
-            if append_dict:
-                for k, v in append_dict.items():
-                    st_dict[st][k] = row[v]
-        else:
-            date_data = {
-                'filepath': None,
-                'search frequency rank': sfr,
-                'asin_data': _render_asin_data(row)
-            }
-            st_dict[st]['data'][date] = date_data
-        return st_dict
+                'min_rank': stats['min_rank'],
+                'avg_rank': stats['avg_rank'],
+                'max_rank': stats['max_rank'],
+                'weeks': weeks,
+                'conversion share': share,
+            })
+        return pd.DataFrame(bind_dict_list, columns=CONVERSION_SHARE_TERM_COLUMNS)
 
-    def st_df_to_sedt_list(self, by, st_df_filtered, st_dict=None, append_dict=None):
+    def _slot_keys(self, st_df):
         """
-        filtered st_df directly convert to searched list, which requires much less memory.
-        :param by:
-        :param st_df_filtered:
-        :return:
+        clicked ASIN slots of each row as the per-date asin_data dict sees them: a repeated ASIN (usually an empty
+        slot) keeps the position of its first slot and the fields of its last one.
+        :return: (asins, kept, source), (rows, 3) arrays; source is the slot index the fields come from
         """
-        if st_dict is None:
-            st_dict = {}
-        if by in ['search term', 'search frequency rank']:
-            for row in st_df_filtered.itertuples():
-                self.df_row_to_st_dict_basic(row, st_dict, append_dict)
+        asin_len = 3
+        codes, uniques = _asin_slot_codes(st_df, asin_len)
+        asins = uniques[codes]
+        same = {(i, j): codes[:, i] == codes[:, j] for i in range(asin_len) for j in range(i + 1, asin_len)}
+        kept = np.ones(asins.shape, dtype=bool)
+        source = np.tile(np.arange(asin_len), (len(asins), 1))
+        for (i, j), mask in same.items():
+            kept[:, j] &= ~mask
+            source[:, i] = np.where(mask, j, source[:, i])
+        return asins, kept, source
+
+    @_profiled('parse_search_list', count=lambda result, args: len(args[2]))
+    def _parse_search_frame(self, by, st_df, st_df_filtered, sort_terms, rank_stats=None):
+        """
+        pandas engine version of _parse_search_list: pivot the filtered rows straight into the result frame,
+        same columns, order and values as the python engine output.
+        :param st_df: the loaded dataset, for rank stats
+        :param st_df_filtered: rows of the matched terms
+        :param sort_terms: order terms alphabetically, otherwise by first appearance
+        :param rank_stats: rank stats of a date window, defaults to those of st_df
+        """
+        asin_len = 3
+        if sort_terms:
+            st_df_filtered = st_df_filtered.sort_values('search term', kind='stable')
         else:
-            for row in st_df_filtered.itertuples():
-                self.df_row_to_st_dict_extended(row, st_dict, append_dict)
-        return st_dict
+            term_codes, _ = pd.factorize(st_df_filtered['search term'])
+            st_df_filtered = st_df_filtered.iloc[np.argsort(term_codes, kind='stable')]
+        st_df_filtered = st_df_filtered.drop_duplicates(['search term', 'date'], keep='last')
+        if st_df_filtered.empty:
+            return self.bind_list_to_df(self._parse_search_list(by, []))
+        term_codes, terms = pd.factorize(st_df_filtered['search term'])
+        date_codes, dates = pd.factorize(st_df_filtered['date'])
+        first_rows = st_df_filtered.drop_duplicates('search term')
+        stats = (self.get_rank_stats(st_df) if rank_stats is None else rank_stats).loc[terms]
+        term_columns = {'site': first_rows.iloc[:, 0].to_numpy(), 'search_term': np.asarray(terms, dtype=object)}
+        for key in ['min_rank', 'avg_rank', 'max_rank']:
+            term_columns[key] = stats[key].to_numpy()
 
-    def search_dataframe_mode(self, by, param, mode, st_df):
-        searched_list, bind_dict_list = [], []
-        condition = {
-            'loose': lambda x, y, z: x in z,
-            'exact': lambda x, y, z: x == y,
-            'mean': lambda x, y, z: x in z,
-        }
+        if by in ['search term', 'search frequency rank']:
+            ranks = _widen_ints(st_df_filtered['search frequency rank'].to_numpy())
+            date_columns = {}
+            for code, date in enumerate(dates):
+                rows = date_codes == code
+                column = pd.Series(np.nan, index=range(len(terms)))
+                column[term_codes[rows]] = ranks[rows]
+                if rows.sum() == len(terms):
+                    column = column.astype(ranks.dtype)
+                date_columns[date] = column.to_numpy()
+            return pd.DataFrame({'site': term_columns['site'], 'search_term': term_columns['search_term'],
+                                 'min_rank': term_columns['min_rank'], **date_columns})
+
+        asins, kept, source = self._slot_keys(st_df_filtered)
+        if by in ['search term asin', 'search frequency rank asin']:
+            # kept keys move up to fill the gaps of repeated ones, like list(asin_data.keys())
+            position = np.cumsum(kept, axis=1) - 1
+            if self.asin_shape == 'long':
+                row_index, slot_index = np.nonzero(kept)
+                base = {k: v[term_codes[row_index]] for k, v in term_columns.items()}
+                return pd.DataFrame({**base, 'date': dates.to_numpy()[date_codes[row_index]],
+                                     'order': position[row_index, slot_index] + 1,
+                                     'clicked asin': asins[row_index, slot_index]})
+            date_columns = {}
+            for code, date in enumerate(dates):
+                column = np.full((len(terms), asin_len), np.nan, dtype=object)
+                rows = np.nonzero(date_codes == code)[0]
+                column[term_codes[rows]] = None
+                row_index, slot_index = np.nonzero(kept[rows])
+                column[term_codes[rows][row_index], position[rows][row_index, slot_index]] = \
+                    asins[rows][row_index, slot_index]
+                date_columns[date] = column.ravel()
+            base = {k: np.repeat(v, asin_len) for k, v in term_columns.items()}
+            return pd.DataFrame({**base, 'order': np.tile(np.arange(1, asin_len + 1), len(terms)), **date_columns})
+
+        row_index, slot_index = np.nonzero(kept)
+        source_index = source[row_index, slot_index]
+        base = {k: v[term_codes[row_index]] for k, v in term_columns.items()}
+        fields = {}
+        for field, column in enumerate(['clicked asin', 'product title', 'click share', 'conversion share']):
+            values = np.column_stack([st_df_filtered.iloc[:, 4 + r * 4 + field].to_numpy() for r in range(asin_len)])
+            values = values[row_index, source_index]
+            fields[column] = _format_shares(values) if column.endswith('share') else values
+        return pd.DataFrame({**base, 'order': source_index + 1, 'date': dates.to_numpy()[date_codes[row_index]],
+                             **fields})
+
+    def search_dataframe_mode(self, by, param, mode, st_df, window=None):
+        bind_dict_list = []
+        rank_stats = None
+        in_window = True
+        if window is not None:
+            rank_stats = window['rank_stats']
+            in_window = st_df['date'].isin(window['dates'])
         if by in ['search term', 'search term asin', 'search term detail']:
             if isinstance(param, str):
                 param = [param]
-            self.param_str = param[0] + '++'
-            st_df_grouped = st_df.groupby('search term')
-            st_dict = {}
-            for st, group in st_df_grouped:
-                for par in param:
-                    if condition[mode](par, st, st):
-                        st_dict = self.st_df_to_sedt_list(by, group, st_dict)
-            for st, value in st_dict.items():
-                sfr = [v['search frequency rank'] for v in value['data'].values()]
-                _calc_rank(by, sfr, value)
-                searched_list.append(value)
-            bind_dict_list = self._parse_search_list(by, searched_list)
+            self.param_str = _param_str(by, param)
+            term_index = self.get_term_index(st_df)
+            matched_terms = set()
+            for par in param:
+                matched_terms.update(term_index.lookup(par, mode))
+            st_df_filtered = st_df[st_df['search term'].isin(matched_terms) & in_window]
+            bind_dict_list = self._parse_search_frame(by, st_df, st_df_filtered, True, rank_stats)
         elif by in ['search frequency rank', 'search frequency rank asin', 'search frequency rank detail']:
 
             if isinstance(param, str) or isinstance(param, int):
                 param = [param]
-            self.param_str = str(param[0])
+            self.param_str = _param_str(by, param)
             param = param[0]
             if isinstance(param, str) and param.isalnum():
                 param = int(param)
@@ -520,59 +2609,165 @@ class SearchEngine:
                 pass
             else:
                 exit('param不是数字形式。')
-            if mode == 'loose':
-                st_df['min_rank'] = st_df.groupby("search term")['search frequency rank'].transform('min')
-                st_df_filtered = st_df[st_df['min_rank'] <= param]
-                st_dict = self.st_df_to_sedt_list(by, st_df_filtered, append_dict={'min_rank': -1})
-                for st, value in st_dict.items():
-                    sfr = [v['search frequency rank'] for v in value['data'].values()]
-                    _calc_rank(by, sfr, value)
-                    searched_list.append(value)
-                searched_list = st_dict.values()
-            elif mode == 'exact':
-                st_df_filtered = st_df[st_df['search frequency rank'] <= param]
-                st_dict = self.st_df_to_sedt_list(by, st_df_filtered)
-                for st, value in st_dict.items():
-                    sfr = [v['search frequency rank'] for v in value['data'].values()]
-                    _calc_rank(by, sfr, value)
-                    searched_list.append(value)
-                searched_list = st_dict.values()
-            elif mode == 'mean':
-                st_df['min_rank'] = st_df.groupby("search term")['search frequency rank'].transform('min')
-                st_df_filtered = st_df[st_df['min_rank'] <= param]
-                st_dict = self.st_df_to_sedt_list(by, st_df_filtered)
-                for st, value in st_dict.items():
-                    sfr = [v['search frequency rank'] for v in value['data'].values()]
-                    _calc_rank(by, sfr, value)
-                    searched_list.append(value)
-                searched_list = st_dict.values()
-            bind_dict_list = self._parse_search_list(by, searched_list)
+            matched_terms = self._rank_filtered_terms(st_df, param, mode, window)
+            st_df_filtered = st_df[st_df['search term'].isin(matched_terms) & in_window]
+            bind_dict_list = self._parse_search_frame(by, st_df, st_df_filtered, False, rank_stats)
         elif by in ['asin detail']:
             if isinstance(param, str):
                 param = [param]
-            self.param_str = param[0] + '++'
-            asin_len = 3
-            filtered_list = []
-            for row in st_df.itertuples():
-                asin_dict = {}
-                asin_list = []
-                for i in range(1, asin_len + 1):
-                    asin_index = 1 + i * 4
-                    asin = row[asin_index]
-                    asin_list.append(asin)
-                    asin_dict[asin] = row[1:5] + (i,) + row[asin_index:asin_index + 4]
-
-                for asin in asin_list:
-                    for par in param:
-                        if condition[mode](par, asin, asin_list):
-                            temp_row = asin_dict[asin]
-                            filtered_list.append(temp_row)
-                            break
-            bind_dict_list = pd.DataFrame(filtered_list, columns=[c.lower() for c in self.BA_ATTRS])
+            self.param_str = _param_str(by, param)
+            rows = self.get_asin_index(st_df).lookup_rows(param)
+            st_df_filtered = st_df[pd.MultiIndex.from_frame(st_df[['search term', 'date']]).isin(rows) & in_window]
+            bind_dict_list = self._asin_detail_frame(st_df_filtered, param, mode)
+        elif by in ['click share asin']:
+            if isinstance(param, str):
+                param = [param]
+            self.param_str = _param_str(by, param)
+            term_index = self.get_term_index(st_df)
+            matched_terms = set()
+            for par in param:
+                matched_terms.update(term_index.lookup(par, mode))
+            st_df_filtered = st_df[st_df['search term'].isin(matched_terms) & in_window]
+            bind_dict_list = self._click_share_asin_frame(st_df_filtered)
+        elif by in ['conversion share term']:
+            threshold = self._share_threshold(param)
+            st_df_filtered = st_df if window is None else st_df[in_window]
+            bind_dict_list = self._conversion_share_term_frame(st_df, st_df_filtered, threshold, mode, rank_stats)
+        elif by in ['brand share']:
+            brand_map = self._brand_map_param(param)
+            bind_dict_list = self._brand_share_frame(st_df, brand_map, in_window)
         bind_df = self.bind_list_to_df(bind_dict_list)
         self.bind_df = bind_df
         return bind_df
 
+    def _asin_detail_frame(self, st_df, param, mode):
+        """
+        unpivot the 3 clicked ASIN slots of st_df into one row per (term, date, slot), in row then slot order.
+        loose keeps every slot of a row holding a param ASIN, exact only the slots holding one.
+        :return: DataFrame with the BA_ATTRS columns
+        """
+        asin_len = 3
+        columns = [c.lower() for c in self.BA_ATTRS]
+        slot_columns = [st_df.columns[4 + r * 4:8 + r * 4] for r in range(asin_len)]
+        codes, uniques = _asin_slot_codes(st_df, asin_len)
+        codes = codes.ravel()
+        param_codes = pd.Index(uniques).get_indexer(pd.unique(pd.Series(param, dtype=object)))
+        mask = np.isin(codes, param_codes[param_codes >= 0])
+        if mode != 'exact':
+            mask = np.repeat(mask.reshape(-1, asin_len).any(axis=1), asin_len)
+        data = {}
+        for column, source in zip(columns[:4], st_df.columns[:4]):
+            data[column] = np.repeat(_widen_ints(st_df[source].to_numpy()), asin_len)[mask]
+        data[columns[4]] = np.tile(np.arange(1, asin_len + 1), len(st_df))[mask]
+        data[columns[5]] = uniques[codes[mask]]
+        for field, column in enumerate(columns[6:], 1):
+            values = np.column_stack([st_df[cols[field]].to_numpy() for cols in slot_columns]).ravel()[mask]
+            data[column] = _format_shares(values) if column.endswith('share') else values
+        return pd.DataFrame(data, columns=columns)
+
+    def _share_slots(self, st_df_filtered):
+        """
+        the clicked ASIN slots of each (term, week) row as the python engine sees them: one row per term and date,
+        repeated ASINs collapsed like the asin_data dict.
+        :return: (rows, asins, kept, slot_field), slot_field(offset) gives the (rows, 3) values of one slot field,
+            0 asin, 1 title, 2 click share, 3 conversion share
+        """
+        rows = st_df_filtered.drop_duplicates(['search term', 'date'], keep='last')
+        asins, kept, source = self._slot_keys(rows)
+
+        def slot_field(offset):
+            values = np.column_stack([rows.iloc[:, 4 + r * 4 + offset].to_numpy() for r in range(3)])
+            return np.take_along_axis(values, source, axis=1)
+
+        return rows, asins, kept, slot_field
+
+    def _click_share_asin_frame(self, st_df_filtered):
+        """
+        pandas engine version of _click_share_asins: click shares are grouped per ASIN in one pass and
+        the top_k picked with np.argpartition instead of sorting every ASIN.
+        """
+        rows, asins, kept, slot_field = self._share_slots(st_df_filtered.sort_values('search term', kind='stable'))
+        row_index, slot_index = np.nonzero(kept & (asins != ''))
+        if len(row_index) == 0:
+            return pd.DataFrame(columns=CLICK_SHARE_ASIN_COLUMNS)
+        slots = pd.DataFrame({
+            'clicked asin': asins[row_index, slot_index],
+            'product title': slot_field(1)[row_index, slot_index],
+            'search term': rows['search term'].to_numpy()[row_index],
+            'click share': _share_values(slot_field(2)[row_index, slot_index]),
+            'conversion share': _share_values(slot_field(3)[row_index, slot_index]),
+        })
+        totals = slots.groupby('clicked asin', sort=False).agg(**{
+            'product title': ('product title', 'first'),
+            'search terms': ('search term', 'nunique'),
+            'term weeks': ('search term', 'size'),
+            'click share': ('click share', 'sum'),
+            'conversion share': ('conversion share', 'sum'),
+        })
+        click_share = _round_share(totals['click share'].to_numpy())
+        top = totals.iloc[_top_k_order(click_share, totals.index.to_numpy(), self.top_k)]
+        return pd.DataFrame({
+            'clicked asin': top.index.to_numpy(),
+            'product title': top['product title'].to_numpy(),
+            'search terms': top['search terms'].to_numpy(),
+            'term weeks': top['term weeks'].to_numpy(),
+            'click share': _round_share(top['click share'].to_numpy()),
+            'avg click share': _round_share((top['click share'] / top['term weeks']).to_numpy()),
+            'conversion share': _round_share(top['conversion share'].to_numpy()),
+        }, columns=CLICK_SHARE_ASIN_COLUMNS)
+
+    def _conversion_share_term_frame(self, st_df, st_df_filtered, threshold, mode, rank_stats=None):
+        """
+        pandas engine version of _conversion_share_terms: weekly conversion shares are summed row-wise,
+        aggregated per term and the top_k of the terms over threshold picked with np.argpartition.
+        :param rank_stats: rank stats of a date window, defaults to those of st_df
+        """
+        rows, asins, kept, slot_field = self._share_slots(st_df_filtered)
+        if rows.empty:
+            return pd.DataFrame(columns=CONVERSION_SHARE_TERM_COLUMNS)
+        shares = _share_values(slot_field(3))
+        weekly = np.where(kept & ~np.isnan(shares), shares, 0).sum(axis=1)
+        grouped = pd.Series(weekly).groupby(rows['search term'].to_numpy(), sort=False)
+        share = _round_share(grouped.agg(SHARE_MODE_STAT[mode]))
+        passed = share[share >= threshold]
+        terms = passed.index[_top_k_order(passed.to_numpy(), passed.index.to_numpy(), self.top_k)]
+        stats = (self.get_rank_stats(st_df) if rank_stats is None else rank_stats).loc[terms]
+        sites = rows.drop_duplicates('search term').set_index('search term').iloc[:, 0]
+        return pd.DataFrame({
+            'site': sites.loc[terms].to_numpy(),
+            'search_term': np.asarray(terms, dtype=object),
+            'min_rank': stats['min_rank'].to_numpy(),
+            'avg_rank': stats['avg_rank'].to_numpy(),
+            'max_rank': stats['max_rank'].to_numpy(),
+            'weeks': grouped.size().loc[terms].to_numpy(),
+            'conversion share': share.loc[terms].to_numpy(),
+        }, columns=CONVERSION_SHARE_TERM_COLUMNS)
+
+    def _brand_share_frame(self, st_df, brand_map, in_window=True):
+        """
+        pandas engine version of _brand_share_postings: ASINs are mapped to brands once per category, rows
+        holding a mapped ASIN are unpivoted into the long ASIN table, then grouped per brand and week.
+        the long table keeps brand, site and date as categoricals and terms and ASINs as integer codes, so
+        grouping does not hash a string per slot.
+        """
+        codes, uniques = _asin_slot_codes(st_df)
+        has_brand = pd.notna(pd.Series(uniques, dtype=object).map(brand_map).to_numpy(dtype=object))
+        rows, asins, kept, slot_field = self._share_slots(st_df[has_brand[codes].any(axis=1) & in_window])
+        codes, uniques = _asin_slot_codes(rows)
+        brand_codes, brands = pd.factorize(pd.Series(uniques, dtype=object).map(brand_map))
+        row_index, slot_index = np.nonzero(kept & (brand_codes[codes] >= 0))
+        slot_codes = codes[row_index, slot_index]
+        slots = pd.DataFrame({
+            'brand': pd.Categorical.from_codes(brand_codes[slot_codes], brands),
+            'site': rows.iloc[:, 0].array.take(row_index),
+            'date': rows['date'].array.take(row_index),
+            'search term': pd.factorize(rows['search term'])[0][row_index],
+            'clicked asin': slot_codes,
+            'click share': _share_values(slot_field(2)[row_index, slot_index]),
+            'conversion share': _share_values(slot_field(3)[row_index, slot_index]),
+        })
+        return _brand_share_table(slots)
+
     def bind_list_to_df(self, bind_dict_list):
         if isinstance(bind_dict_list, pd.DataFrame):
             df = bind_dict_list
@@ -580,35 +2775,363 @@ class SearchEngine:
             df = pd.DataFrame(bind_dict_list)
         return df
 
-    def search(self, by, param, mode, engine, st_data=None):
-        print('start searching.')
+    def _result_key(self, by, param, mode, engine, version, start=None, end=None):
+        if self.result_cache is None or version is None:
+            return None
+        window = [str(start), str(end)] if start is not None or end is not None else []
+        top_k = [self.top_k] if by in ['click share asin', 'conversion share term'] else []
+        if by in ['brand share']:
+            # the mapping, not just the ASINs or the mapping file name, decides the result
+            param = [f'{asin}={brand}' for asin, brand in sorted(_read_brand_map(param).items())]
+        return ResultCache.make_key(by, param, mode, engine, version, self.asin_shape, *window, *top_k)
+
+    @_profiled('search')
+    def run_query(self, by, param, mode, engine, st_data=None, start=None, end=None):
+        """
+        search with the result cache; results are cached only for the dataset loaded by this object,
+        under its dataset version.
+        :param start: first day of the date window, None for unbounded
+        :param end: last day of the date window, None for unbounded
+        """
+        if st_data is None:
+            st_data = self.st_data
+        version = self.dataset_version if st_data is self.st_data else None
+        key = self._result_key(by, param, mode, engine, version, start, end)
+        if key is not None:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                bind_df, self.param_str = cached
+                self.bind_df = bind_df
+                return bind_df
+        window = self.get_window(st_data, start, end)
+        if isinstance(st_data, MappedStore):
+            st_data, window = self._read_mapped(st_data, by, param, mode, window)
         if engine in ['python']:
-            bind_df = self.search_dict_mode(by, param, mode, st_data)
+            bind_df = self.search_dict_mode(by, param, mode, st_data, window)
         else:
-            bind_df = self.search_dataframe_mode(by, param, mode, st_data)
+            bind_df = self.search_dataframe_mode(by, param, mode, st_data, window)
+        if key is not None:
+            # not self.param_str: concurrent queries on a shared object overwrite it
+            self.result_cache.put(key, bind_df, _param_str(by, param))
+        return bind_df
+
+    def _read_mapped(self, store, by, param, mode, window):
+        """
+        the rows of a MappedStore a query can return, read with the query pushed down like a filtered load.
+        without a date window the query runs on a window over every week, so it takes the rank stats of the whole
+        store rather than recomputing them from the rows read.
+        :return: (st_df, window)
+        """
+        if window is None:
+            window = {'dates': {date for date, start, stop in store.partitions},
+                      'rank_stats': self.get_rank_stats(store)}
+        return store.frame(LoadFilter(by, param, mode), window['dates']), window
+
+    def search(self, by, param, mode, engine, st_data=None, start=None, end=None):
+        print('start searching.')
+        bind_df = self.run_query(by, param, mode, engine, st_data, start, end)
         print(bind_df)
         return bind_df
 
-    def save_search(self, bind_df, by, param_str, mode, engine, dirpath, save_dirpath):
+    def _cached_result_before_load(self, by, param, mode, engine, abs_file_data, start=None, end=None):
+        """
+        look up a persisted result before any report is parsed.
+        """
+        if self.result_cache is None or not abs_file_data['csv']:
+            return None
+        self._get_report_cache(abs_file_data)
+        key = self._result_key(by, param, mode, engine, _dataset_version(abs_file_data['csv']), start, end)
+        return self.result_cache.get(key)
+
+    def _write_sheet_rows(self, workbook, sheet_name, sheet_df):
+        """
+        write one sheet in row order, which xlsxwriter's constant_memory mode requires; DataFrame.to_excel writes
+        column by column and would lose all but the last row. same layout as to_excel: index in the first column,
+        bold column names on the first row, empty cells for missing values.
+        """
+        worksheet = workbook.add_worksheet(sheet_name)
+        header_format = workbook.add_format({'bold': True})
+        if sheet_df.index.name is not None:
+            worksheet.write(0, 0, _excel_value(sheet_df.index.name), header_format)
+        worksheet.write_row(0, 1, [_excel_value(c) for c in sheet_df.columns], header_format)
+        for row_no, row in enumerate(sheet_df.itertuples(name=None), 1):
+            worksheet.write_row(row_no, 0, [_excel_value(v) for v in row])
+
+    def _save_excel(self, bind_df, base_path):
+        """
+        write xlsx with a constant-memory writer when xlsxwriter is installed. results over the sheet row
+        limit are split into sheets, and into several files past EXCEL_MAX_SHEETS sheets.
+        :return: written file paths
+        """
+        constant_memory = _has_module('xlsxwriter')
+        rows_per_file = self.EXCEL_MAX_ROWS * self.EXCEL_MAX_SHEETS
+        n_files = max(1, -(-len(bind_df) // rows_per_file))
+        save_file_paths = []
+        for file_no in range(n_files):
+            file_df = bind_df.iloc[file_no * rows_per_file:(file_no + 1) * rows_per_file]
+            suffix = f'-part{file_no + 1}' if n_files > 1 else ''
+            save_file_path = f'{base_path}{suffix}.xlsx'
+            n_sheets = max(1, -(-len(file_df) // self.EXCEL_MAX_ROWS))
+            sheets = [(f'Sheet{sheet_no + 1}',
+                       file_df.iloc[sheet_no * self.EXCEL_MAX_ROWS:(sheet_no + 1) * self.EXCEL_MAX_ROWS])
+                      for sheet_no in range(n_sheets)]
+            if constant_memory:
+                import xlsxwriter
+                workbook = xlsxwriter.Workbook(save_file_path, {'constant_memory': True,
+                                                                'default_date_format': 'yyyy-mm-dd'})
+                try:
+                    for sheet_name, sheet_df in sheets:
+                        self._write_sheet_rows(workbook, sheet_name, sheet_df)
+                finally:
+                    workbook.close()
+            else:
+                with pd.ExcelWriter(save_file_path) as writer:
+                    for sheet_name, sheet_df in sheets:
+                        sheet_df.to_excel(writer, sheet_name=sheet_name)
+            save_file_paths.append(save_file_path)
+        return save_file_paths
+
+    @_profiled('save', count=lambda result, args: len(args[0]))
+    def save_search(self, bind_df, by, param_str, mode, engine, dirpath, save_dirpath, output_format=None):
+        """
+        :param output_format: 'xlsx', 'csv' or 'parquet', defaults to self.output_format
+        """
         if save_dirpath is None:
             save_dirpath = dirpath
+        if output_format is None:
+            output_format = self.output_format
         nowtime = datetime.now().strftime('%Y%m%d-%H%M%S')
-        save_file_path = os.path.join(save_dirpath, f'result-{mode}-{by}-{param_str}-{engine}-{nowtime}.xlsx')
-        bind_df.to_excel(save_file_path)
-        print(f'保存文件：{save_file_path}')
+        base_path = os.path.join(save_dirpath, f'result-{mode}-{by}-{param_str}-{engine}-{nowtime}')
+        if output_format == 'parquet' and not _has_module('pyarrow'):
+            print('未安装 pyarrow，改为保存 csv。')
+            output_format = 'csv'
+        if output_format == 'csv':
+            save_file_paths = [f'{base_path}.csv']
+            bind_df.to_csv(save_file_paths[0], chunksize=self.EXPORT_CHUNKSIZE, encoding='utf-8-sig')
+        elif output_format == 'parquet':
+            save_file_paths = [f'{base_path}.parquet']
+            bind_df.rename(columns=str).to_parquet(save_file_paths[0])
+        else:
+            save_file_paths = self._save_excel(bind_df, base_path)
+        for save_file_path in save_file_paths:
+            print(f'保存文件：{save_file_path}')
+        return save_file_paths
 
-    def operator_mechine(self, by, param, mode, engine, dirpath, save_dirpath=None):
+    def query_files(self, by, param, mode, engine, abs_file_data, start=None, end=None):
+        """
+        answer one query from the given reports: the result cache is checked before anything is parsed,
+        otherwise the reports are loaded with the query pushed down.
+        :return: (bind_df, param_str)
+        """
+        cached = self._cached_result_before_load(by, param, mode, engine, abs_file_data, start, end)
+        if cached is not None:
+            return cached
+        st_data = self.set_search_term_data(by, engine, abs_file_data, load_filter=LoadFilter(by, param, mode))
+        return self.run_query(by, param, mode, engine, st_data, start, end), _param_str(by, param)
+
+    @_profiled('total')
+    def operator_mechine(self, by, param, mode, engine, dirpath, save_dirpath=None, start=None, end=None):
         abs_file_data = self._get_abs_files_data(dirpath)
-        st_data = self.set_search_term_data(by, engine, abs_file_data)
-        bind_df = self.search(by, param, mode, engine, st_data)
+        cached = self._cached_result_before_load(by, param, mode, engine, abs_file_data, start, end)
+        if cached is not None:
+            bind_df, param_str = cached
+            print('命中结果缓存。')
+            print(bind_df)
+            self.save_search(bind_df, by, param_str, mode, engine, dirpath, save_dirpath)
+            return
+        st_data = self.set_search_term_data(by, engine, abs_file_data, load_filter=LoadFilter(by, param, mode))
+        bind_df = self.search(by, param, mode, engine, st_data, start, end)
         st_data = 0
-        param_str = self.param_str
+        param_str = _param_str(by, param)
         self.save_search(bind_df, by, param_str, mode, engine, dirpath, save_dirpath)
 
+    def search_batch(self, specs, engine, st_data=None):
+        """
+        evaluate many queries against one loaded dataset. the term index, rank stats and ASIN index are
+        built on the first query that needs them and shared by the rest.
+        :param specs: [{'by': ..., 'param': ..., 'mode': ..., 'start': None, 'end': None}, ...],
+            start and end are optional
+        :return: [(spec, bind_df, param_str), ...] in spec order
+        """
+        if st_data is None:
+            st_data = self.st_data
+        results = []
+        for index, spec in enumerate(specs):
+            print(f'query {index + 1}/{len(specs)}: {spec["by"]}, {spec["mode"]}')
+            bind_df = self.search(spec['by'], spec['param'], spec['mode'], engine, st_data, spec.get('start'),
+                                  spec.get('end'))
+            results.append((spec, bind_df, _param_str(spec['by'], spec['param'])))
+        return results
+
+    @_profiled('total')
+    def operator_batch(self, specs, engine, dirpath, save_dirpath=None):
+        """
+        load the folder once for all specs, then write one result file per query.
+        """
+        abs_file_data = self._get_abs_files_data(dirpath)
+        basic_by = ['search term', 'search frequency rank']
+        by = 'search term' if all(spec['by'] in basic_by for spec in specs) else 'asin detail'
+        st_data = self.set_search_term_data(by, engine, abs_file_data)
+        for spec, bind_df, param_str in self.search_batch(specs, engine, st_data):
+            self.save_search(bind_df, spec['by'], param_str, spec['mode'], engine, dirpath, save_dirpath)
+
+
+def _read_report_header(file):
+    """
+    :return: (Viewing date label, site of the first row or None)
+    """
+    with open(file, 'r', encoding='UTF-8') as fp:
+        reader = csv.reader(fp, delimiter=',')
+        date = _parse_viewing_date(next(reader))
+        next(reader, None)
+        first_row = next(reader, None)
+    return date, first_row[0] if first_row else None
+
+
+def _query_partition(by, param, mode, engine, abs_file_data, use_cache, asin_shape, start, end, top_k):
+    st_object = SearchEngine(engine, use_cache=use_cache, asin_shape=asin_shape, top_k=top_k)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return st_object.query_files(by, param, mode, engine, abs_file_data, start, end)
+
+
+class Corpus:
+    """
+    多站点、多文件夹的品牌分析数据：每个文件夹登记为一个站点分区，分区内记录每个周报的日期范围。
+    查询时按站点和日期范围裁剪，只读取相关的文件；涉及多个分区时各分区并行查询后合并结果。
+    每个文件夹仍各自使用自己的解析缓存和结果缓存。
+    """
+
+    def __init__(self, engine='pandas', workers=1, use_cache=True, asin_shape='wide', output_format='xlsx', top_k=50):
+        """
+        :param workers: partitions queried in parallel
+        :param top_k: rows of the share rankings, over all queried partitions
+        """
+        self.engine = engine
+        self.workers = workers
+        self.use_cache = use_cache
+        self.asin_shape = asin_shape
+        self.output_format = output_format
+        self.top_k = top_k
+        self.partitions = []
 
-def search(by, param, mode, engine, dirpath, save_dirpath=None):
-    st_object = SearchEngine()
-    st_object.operator_mechine(by, param, mode, engine, dirpath, save_dirpath)
+    def add(self, dirpath, site=None):
+        """
+        register a folder of one marketplace.
+        :param site: partition name, defaults to the site (department) of the reports
+        :return: the partition
+        """
+        partition = {'dirpath': dirpath, 'site': site, 'files': {}}
+        self._scan(partition)
+        if partition['site'] is None:
+            sites = {value[3] for value in partition['files'].values() if value[3]}
+            assert len(sites) <= 1, f'{dirpath} 中有多个站点的文件：{sorted(sites)}'
+            partition['site'] = sites.pop() if sites else os.path.basename(os.path.normpath(dirpath))
+        self.partitions.append(partition)
+        print(f"registered {partition['site']}: {dirpath}, {len(partition['files'])} files.")
+        return partition
+
+    def _scan(self, partition):
+        """
+        refresh the date range of the partition's files, re-reading the header of new or changed files only.
+        """
+        known = partition['files']
+        files = {}
+        for file in SearchEngine()._get_abs_files_data(partition['dirpath'])['csv']:
+            fingerprint = _file_fingerprint(file)
+            if file in known and known[file][0] == fingerprint:
+                files[file] = known[file]
+                continue
+            date, site = _read_report_header(file)
+            start, end = _report_date_range(date)
+            files[file] = (fingerprint, start, end, site)
+        partition['files'] = files
+
+    def sites(self):
+        return [partition['site'] for partition in self.partitions]
+
+    def prune(self, sites=None, start=None, end=None):
+        """
+        partitions and files a query bounded by sites and dates has to read.
+        files whose Viewing date cannot be parsed are always kept.
+        :param sites: partition sites, None for all
+        :param start: first day, anything pd.Timestamp accepts, None for unbounded
+        :param end: last day, None for unbounded
+        :return: [(partition, abs_file_data), ...] of partitions with at least one file left
+        """
+        if isinstance(sites, str):
+            sites = [sites]
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        selected = []
+        for partition in self.partitions:
+            if sites is not None and partition['site'] not in sites:
+                continue
+            self._scan(partition)
+            files = []
+            for file, (fingerprint, first_day, last_day, site) in partition['files'].items():
+                if start is not None and pd.notna(last_day) and last_day < start:
+                    continue
+                if end is not None and pd.notna(first_day) and first_day > end:
+                    continue
+                files.append(file)
+            if files:
+                abs_file_data = {'dirpath': partition['dirpath'], 'csv': files, 'hdf': None, 'json': None,
+                                 'all_csv': list(partition['files'])}
+                selected.append((partition, abs_file_data))
+        return selected
+
+    def query(self, by, param, mode, sites=None, start=None, end=None):
+        """
+        run one query over the pruned partitions and concatenate their results in partition order.
+        results without a site column get the partition's site as their first column. the share rankings are
+        cut to the top_k over all partitions, each partition returns its own top_k.
+        rank stats are computed over the weeks starting inside [start, end].
+        :return: (bind_df, param_str)
+        """
+        selected = self.prune(sites, start, end)
+        if not selected:
+            print('没有符合站点和日期范围的文件。')
+            return pd.DataFrame(), None
+        jobs = [(by, param, mode, self.engine, abs_file_data, self.use_cache, self.asin_shape, start, end, self.top_k)
+                for partition, abs_file_data in selected]
+        print(f"querying {', '.join(partition['site'] for partition, _ in selected)}.")
+        if self.workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as executor:
+                results = list(executor.map(_query_partition, *zip(*jobs)))
+        else:
+            results = [_query_partition(*job) for job in jobs]
+        frames = []
+        for (partition, abs_file_data), (bind_df, param_str) in zip(selected, results):
+            if bind_df.empty:
+                continue
+            if 'site' not in bind_df.columns:
+                bind_df.insert(loc=0, column='site', value=partition['site'])
+            frames.append(bind_df)
+        bind_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if by in TOP_K_ORDER and len(frames) > 1:
+            value, label = TOP_K_ORDER[by]
+            bind_df = bind_df.sort_values([value, label], ascending=[False, True], kind='stable')
+            bind_df = bind_df.head(self.top_k).reset_index(drop=True)
+        return bind_df, results[0][1]
+
+    def operator_mechine(self, by, param, mode, save_dirpath, sites=None, start=None, end=None):
+        bind_df, param_str = self.query(by, param, mode, sites, start, end)
+        print(bind_df)
+        st_object = SearchEngine(self.engine, output_format=self.output_format)
+        return st_object.save_search(bind_df, by, param_str, mode, self.engine, save_dirpath, save_dirpath)
+
+
+def search(by, param, mode, engine, dirpath, save_dirpath=None, streaming=False, workers=1, output_format='xlsx',
+           profiler=None, start=None, end=None, top_k=50):
+    st_object = SearchEngine(streaming=streaming, workers=workers, output_format=output_format, profiler=profiler,
+                             top_k=top_k)
+    st_object.operator_mechine(by, param, mode, engine, dirpath, save_dirpath, start, end)
+    st_object = 0
+
+
+def search_batch(specs, engine, dirpath, save_dirpath=None, workers=1, output_format='xlsx', profiler=None, top_k=50):
+    st_object = SearchEngine(workers=workers, output_format=output_format, profiler=profiler, top_k=top_k)
+    st_object.operator_batch(specs, engine, dirpath, save_dirpath)
     st_object = 0
 
 
@@ -621,19 +3144,21 @@ def run2():
         excel_path = verified_input(lambda: ver_param_path())
         df = pd.read_excel(excel_path)
         df.columns = [c.lower() for c in df.columns]
-        by = df['by'][0]
-        print(f'by: {by}')
-        param = df['param'].to_list()
-        print(f'param: {str(param)}')
-        mode = df['mode'][0]
-        print(f'mode: {mode}')
-
-        if by in SearchEngine.AVAILABLE_BY and mode in SearchEngine.AVAILABLE_MODE:
-            return by, param, mode, excel_path
-        else:
-            return False
+        # by/mode may be filled only on the first row of each query; every (by, mode) group is one query.
+        df['by'] = df['by'].ffill()
+        df['mode'] = df['mode'].ffill()
+        specs = []
+        for (by, mode), group in df.groupby(['by', 'mode'], sort=False):
+            param = group['param'].dropna().to_list()
+            print(f'by: {by}')
+            print(f'param: {str(param)}')
+            print(f'mode: {mode}')
+            if by not in SearchEngine.AVAILABLE_BY or mode not in SearchEngine.available_modes(by):
+                return False
+            specs.append({'by': by, 'param': param, 'mode': mode})
+        return (specs, excel_path) if specs else False
 
-    by, param, mode, excel_path = verified_input(lambda: ver_param(), "表格不正确", '错误的参数表格。')
+    specs, excel_path = verified_input(lambda: ver_param(), "表格不正确", '错误的参数表格。')
 
     def ver_engine():
         engine_id = input('选择处理引擎编号 (1.pandas, 2.python，默认为pandas, python可能更快但需要更多运存): ') or '1'
@@ -648,11 +3173,61 @@ def run2():
 
     engine = verified_input(lambda: ver_engine(), "错误设置引擎, 请重试", "错误输入太多，程序退出。")
 
+    def ver_workers():
+        workers = input(f'并行读取进程数 (默认为1, 本机 {os.cpu_count()} 核): ').strip() or '1'
+        return int(workers) if workers.isdigit() and int(workers) > 0 else False
+
+    workers = verified_input(lambda: ver_workers(), "错误的进程数, 请重试", "错误输入太多，程序退出。")
+
     def ver_save_dirpath():
         save_dirpath = input('结果保存位置 (默认与参数表格同文件夹)：').strip('\"').strip() or os.path.dirname(excel_path)
         return save_dirpath if os.path.exists(save_dirpath) else False
 
     save_dirpath = verified_input(lambda: ver_save_dirpath())
 
-    dirpath = input('输入品牌分析文件夹: ').strip('\"').strip() or r'D:\HollyWork\调研\品牌分析\UK ABA'
-    search(by, param, mode, engine, dirpath, save_dirpath)
+    def ver_output_format():
+        format_id = input('结果文件格式 (1.xlsx, 2.csv, 3.parquet，默认为xlsx, 结果很大时建议csv): ') or '1'
+        output_formats = dict(zip(['1', '2', '3'], SearchEngine.AVAILABLE_OUTPUT_FORMAT))
+        return output_formats.get(format_id, False)
+
+    output_format = verified_input(lambda: ver_output_format(), "错误的格式, 请重试", "错误输入太多，程序退出。")
+
+    def ver_top_k():
+        top_k = input('排名返回条数 (默认为50): ').strip() or '50'
+        return int(top_k) if top_k.isdigit() and int(top_k) > 0 else False
+
+    top_k = 50
+    if any(spec['by'] in ['click share asin', 'conversion share term'] for spec in specs):
+        top_k = verified_input(lambda: ver_top_k(), "错误的条数, 请重试", "错误输入太多，程序退出。")
+
+    dirpath = input('输入品牌分析文件夹 (多个站点用 ; 分隔): ').strip('\"').strip() or r'D:\HollyWork\调研\品牌分析\UK ABA'
+    profile_path = input('各阶段耗时记录文件 (.jsonl, 留空不记录)：').strip('\"').strip()
+
+    def ver_date_range():
+        date_range = input('日期范围 (如 2021-07-01~2021-09-30, 整月整季度直接用汇总, 留空为全部): ').strip()
+        if not date_range:
+            return None, None
+        start, _, end = date_range.partition('~')
+        try:
+            return _window_bounds(start.strip() or None, end.strip() or None)
+        except ValueError:
+            return False
+
+    start, end = verified_input(lambda: ver_date_range(), "错误的日期范围, 请重试", "错误输入太多，程序退出。")
+    profiler = StageProfiler(enabled=True, json_path=profile_path) if profile_path else None
+    dirpaths = [d.strip().strip('\"').strip() for d in dirpath.split(';') if d.strip()]
+    if len(dirpaths) > 1:
+        corpus = Corpus(engine, workers=workers, output_format=output_format, top_k=top_k)
+        for path in dirpaths:
+            corpus.add(path)
+        for spec in specs:
+            corpus.operator_mechine(spec['by'], spec['param'], spec['mode'], save_dirpath, start=start, end=end)
+    elif len(specs) == 1:
+        spec = specs[0]
+        search(spec['by'], spec['param'], spec['mode'], engine, dirpath, save_dirpath, workers=workers,
+               output_format=output_format, profiler=profiler, start=start, end=end, top_k=top_k)
+    else:
+        for spec in specs:
+            spec.update(start=start, end=end)
+        search_batch(specs, engine, dirpath, save_dirpath, workers=workers, output_format=output_format,
+                     profiler=profiler, top_k=top_k)
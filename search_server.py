@@ -0,0 +1,257 @@
+import argparse
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from seach_engine import CompactStore, MappedStore, SearchEngine
+
+
+class RWLock:
+    """
+    多读单写锁：查询并发读取，刷新数据时独占。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            while self._writing or self._readers > 0:
+                self._cond.wait()
+            self._writing = True
+
+    def release_write(self):
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+
+def dataset_nbytes(st_data):
+    if isinstance(st_data, pd.DataFrame):
+        return int(st_data.memory_usage(deep=True).sum())
+    if isinstance(st_data, (CompactStore, MappedStore)):
+        return st_data.nbytes()
+    return 0
+
+
+class QueryService:
+    """
+    常驻内存的查询服务：数据只加载一次，索引和 rank 统计预先建好，之后并发回答查询。
+    """
+
+    def __init__(self, dirpath, engine='pandas', workers=1, memory_budget=None, lazy=False):
+        """
+        :param memory_budget: max size of the loaded dataset in MB, None for no limit
+        :param lazy: pandas engine: serve from the memory-mapped columnar cache instead of loading every week
+        """
+        self.dirpath = dirpath
+        self.engine = engine
+        self.memory_budget = memory_budget
+        self.lock = RWLock()
+        self.st_object = SearchEngine(engine, workers=workers, lazy=lazy)
+
+    def _check_budget(self, nbytes=None):
+        """
+        :param nbytes: dataset size to check, None for the size of the loaded dataset
+        """
+        if nbytes is None:
+            nbytes = dataset_nbytes(self.st_object.st_data)
+        if self.memory_budget is not None and nbytes > self.memory_budget * 1024 * 1024:
+            raise MemoryError(f'dataset needs {nbytes / 1024 / 1024:.0f} MB, over the {self.memory_budget} MB budget.')
+        return nbytes
+
+    def _prepare(self):
+        st_data = self.st_object.st_data
+        if isinstance(st_data, CompactStore):
+            st_data.finalize()
+        self.st_object.get_rank_stats(st_data)
+        for freq in ['M', 'Q']:
+            self.st_object.get_rank_rollup(st_data, freq)
+        if isinstance(st_data, MappedStore):
+            # queries read their own rows from the store and index only those
+            return
+        self.st_object.get_term_index(st_data).token_postings()
+        self.st_object.get_asin_index(st_data)
+
+    def load(self):
+        self.lock.acquire_write()
+        try:
+            abs_file_data = self.st_object._get_abs_files_data(self.dirpath)
+            self.st_object.set_search_term_data('asin detail', self.engine, abs_file_data)
+            nbytes = self._check_budget()
+            self._prepare()
+        finally:
+            self.lock.release_write()
+        print(f'loaded {self.dirpath}: {len(abs_file_data["csv"])} files, {nbytes / 1024 / 1024:.0f} MB.')
+
+    def refresh(self):
+        self.lock.acquire_write()
+        try:
+            # checked on an estimate before loading: a refresh is applied in place and cannot be undone
+            self._check_budget(self.st_object.estimate_refresh_nbytes(dataset_nbytes(self.st_object.st_data)))
+            updated_files = self.st_object.refresh()
+            if updated_files:
+                self._prepare()
+            return updated_files
+        finally:
+            self.lock.release_write()
+
+    def status(self):
+        self.lock.acquire_read()
+        try:
+            loaded = self.st_object.loaded
+            return {
+                'dirpath': self.dirpath,
+                'engine': self.engine,
+                'files': len(loaded['fingerprints']) if loaded else 0,
+                'version': self.st_object.dataset_version,
+                'mb': round(dataset_nbytes(self.st_object.st_data) / 1024 / 1024, 1),
+            }
+        finally:
+            self.lock.release_read()
+
+    def query(self, by, param, mode, limit=1000, start=None, end=None):
+        """
+        :param start: first day of the date window, None for unbounded
+        :param end: last day of the date window, None for unbounded
+        :return: (total rows, result frame truncated to limit)
+        """
+        if by not in SearchEngine.AVAILABLE_BY:
+            raise ValueError(f'unknown by: {by}')
+        if mode not in SearchEngine.available_modes(by):
+            raise ValueError(f'unknown mode for {by}: {mode}')
+        self.lock.acquire_read()
+        try:
+            bind_df = self.st_object.run_query(by, param, mode, self.engine, start=start, end=end)
+        finally:
+            self.lock.release_read()
+        return len(bind_df), bind_df.head(limit)
+
+    def watch(self, interval):
+        def run():
+            while True:
+                stop.wait(interval)
+                if stop.is_set():
+                    return
+                try:
+                    updated_files = self.refresh()
+                except MemoryError as e:
+                    print(f'refresh refused: {e}')
+                    continue
+                except Exception as e:
+                    # e.g. a csv still being downloaded; keep polling, the next round retries it
+                    print(f'refresh failed: {e!r}')
+                    continue
+                if updated_files:
+                    print(f'{len(updated_files)} file(s) loaded.')
+
+        stop = threading.Event()
+        threading.Thread(target=run, daemon=True).start()
+        return stop
+
+
+def make_handler(service):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def _send_json(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode('UTF-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def do_GET(self):
+            if self.path == '/status':
+                self._send_json(200, service.status())
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            try:
+                if self.path == '/search':
+                    body = self._read_json()
+                    total, bind_df = service.query(body['by'], body['param'], body.get('mode', 'loose'),
+                                                   int(body.get('limit', 1000)), body.get('start'), body.get('end'))
+                    result = json.loads(bind_df.to_json(orient='split', index=False, force_ascii=False))
+                    self._send_json(200, {'rows': total, 'columns': result['columns'], 'data': result['data']})
+                elif self.path == '/refresh':
+                    self._send_json(200, {'updated': service.refresh()})
+                else:
+                    self._send_json(404, {'error': 'not found'})
+            except (KeyError, ValueError, TypeError) as e:
+                self._send_json(400, {'error': repr(e)})
+            except SystemExit as e:
+                self._send_json(400, {'error': str(e)})
+            except MemoryError as e:
+                self._send_json(507, {'error': str(e)})
+            except Exception as e:
+                self._send_json(500, {'error': repr(e)})
+
+    return QueryHandler
+
+
+def serve(dirpath, engine='pandas', host='127.0.0.1', port=8765, workers=1, memory_budget=None, watch=None,
+          lazy=False):
+    """
+    load a Brand Analytics folder once and answer queries over HTTP:
+        GET  /status
+        POST /search   {"by": ..., "param": ..., "mode": ..., "limit": 1000, "start": "2021-07-01", "end": "2021-09-30"}
+        POST /refresh
+    :param watch: refresh interval in seconds, None to refresh only on request
+    :param lazy: serve from the memory-mapped columnar cache, see SearchEngine
+    """
+    service = QueryService(dirpath, engine, workers, memory_budget, lazy)
+    service.load()
+    if watch:
+        service.watch(watch)
+    httpd = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f'serving on http://{host}:{port}')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('server stopped.')
+    finally:
+        httpd.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='品牌分析常驻查询服务')
+    parser.add_argument('dirpath', help='品牌分析文件夹')
+    parser.add_argument('--engine', choices=SearchEngine.AVAILABLE_ENGINE, default='pandas')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1, help='并行读取进程数')
+    parser.add_argument('--memory-budget', type=int, default=None, help='数据占用内存上限 (MB)')
+    parser.add_argument('--watch', type=int, default=None, help='自动刷新间隔 (秒)')
+    parser.add_argument('--lazy', action='store_true', help='以 mmap 方式打开列式缓存，按需读取 (仅 pandas 引擎)')
+    args = parser.parse_args(argv)
+    try:
+        serve(args.dirpath, args.engine, args.host, args.port, args.workers, args.memory_budget, args.watch,
+              args.lazy)
+    except MemoryError as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main()